@@ -17,15 +17,18 @@
 import os
 import time
 import traceback
+from collections import OrderedDict
 from concurrent import futures
+import hashlib
+import itertools
 import json
 import threading
 
 import googlecloudprofiler
 from google.auth.exceptions import DefaultCredentialsError
 import grpc
-import google.generativeai as genai
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify, stream_with_context
+from waitress import serve
 
 import demo_pb2
 import demo_pb2_grpc
@@ -41,15 +44,81 @@ from opentelemetry.exporter.otlp.proto.grpc.trace_exporter import OTLPSpanExport
 from logger import getJSONLogger
 logger = getJSONLogger('chatbotservice-server')
 
+# The Gemini SDK is imported on first use so that processes running without
+# GEMINI_API_KEY (including test runs) skip its start-up cost.
+genai = None
+
+def _ensure_genai():
+    global genai
+    if genai is None:
+        import google.generativeai as _genai
+        genai = _genai
+
+# The semantic cache tier is optional: it is only enabled when
+# sentence-transformers (and numpy) are installed in the image.
+try:
+    import numpy as np
+    from sentence_transformers import SentenceTransformer
+except ImportError:
+    np = None
+    SentenceTransformer = None
+
+LLM_CACHE_TTL_SECONDS = int(os.environ.get('LLM_CACHE_TTL_SECONDS', 3600))
+LLM_CACHE_MAX_ENTRIES = int(os.environ.get('LLM_CACHE_MAX_ENTRIES', 10000))
+LLM_CACHE_SIMILARITY_THRESHOLD = float(os.environ.get('LLM_CACHE_SIMILARITY_THRESHOLD', 0.92))
+LLM_CACHE_EMBEDDING_MODEL = 'sentence-transformers/all-MiniLM-L6-v2'
+
+# HTTP/2 tuning so each client connection can carry many in-flight RPCs
+GRPC_SERVER_OPTIONS = [
+    ("grpc.max_concurrent_streams", 1000),
+    ("grpc.http2.max_frame_size", 1048576),
+    ("grpc.keepalive_time_ms", 30000),
+    ("grpc.keepalive_timeout_ms", 10000),
+    ("grpc.http2.min_time_between_pings_ms", 10000),
+    ("grpc.http2.min_ping_interval_without_data_ms", 10000),
+    ("grpc.http2.max_pings_without_data", 0),
+    ("grpc.so_reuseport", 1),
+]
+
+GRPC_CLIENT_OPTIONS = [
+    ("grpc.keepalive_time_ms", 30000),
+    ("grpc.keepalive_timeout_ms", 10000),
+    ("grpc.http2.bdp_probe", 1),
+]
+
+# Sent once as the model's system instruction rather than prepended to every message
+CHAT_SYSTEM_PROMPT = """You are a helpful customer support agent for Online Boutique, an e-commerce platform.
+You help customers with:
+- Product inquiries
+- Order status and tracking
+- Returns and refunds
+- Account issues
+- General shopping assistance
+
+Be friendly, professional, and concise. If you cannot help with something,
+politely direct them to contact human support."""
+
+# Fallback intents in priority order: (keywords, response)
+FALLBACK_INTENTS = (
+    (('order', 'tracking', 'status'),
+     "I can help you track your order! Please provide your order number and I'll look it up for you."),
+    (('return', 'refund', 'exchange'),
+     "For returns and refunds, please visit our returns page or contact our support team. We're happy to help!"),
+    (('product', 'item', 'availability'),
+     "I can help you find products! What are you looking for today?"),
+    (('shipping', 'delivery'),
+     "We offer various shipping options. Standard delivery is 3-5 business days, and express is 1-2 days."),
+)
+FALLBACK_DEFAULT_RESPONSE = "Thank you for contacting Online Boutique support! How can I help you today?"
+
 # Create Flask app for HTTP endpoints
 app = Flask(__name__)
 
 def initStackdriverProfiling():
-    project_id = None
-    try:
-        project_id = os.environ["GCP_PROJECT_ID"]
-    except KeyError:
-        pass
+    if "DISABLE_PROFILER" in os.environ:
+        return
+
+    project_id = os.environ.get("GCP_PROJECT_ID")
 
     for retry in range(1,4):
         try:
@@ -59,93 +128,266 @@ def initStackdriverProfiling():
                 googlecloudprofiler.start(service='chatbot_server', service_version='1.0.0', verbose=0)
             logger.info("Successfully started Stackdriver Profiler.")
             return
+        except ImportError as exc:
+            logger.warning("Stackdriver Profiler agent is not available, not retrying. " + str(exc))
+            return
         except (BaseException) as exc:
             logger.info("Unable to start Stackdriver Profiler Python agent. " + str(exc))
-            if (retry < 4):
-                logger.info("Sleeping %d seconds to retry Stackdriver Profiler agent initialization"%(retry*10))
-                time.sleep (1)
+            if (retry < 3):
+                delay = min(30, 2 ** retry)
+                logger.info("Sleeping %d seconds to retry Stackdriver Profiler agent initialization"%(delay))
+                time.sleep(delay)
             else:
                 logger.warning("Could not initialize Stackdriver Profiler after retrying, giving up")
-    return
+
+class SemanticCache(object):
+    """LRU cache of AI responses with an exact and a semantic lookup tier.
+
+    The exact tier is keyed by a hash of the normalized message. When an
+    embedding model is available, a miss on the exact tier falls back to a
+    cosine-similarity search over the embeddings of all cached messages.
+    """
+
+    def __init__(self, max_entries=LLM_CACHE_MAX_ENTRIES, ttl_seconds=LLM_CACHE_TTL_SECONDS,
+                 similarity_threshold=LLM_CACHE_SIMILARITY_THRESHOLD):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.similarity_threshold = similarity_threshold
+        self._lock = threading.Lock()
+        # key -> (expires_at, response, embedding slot)
+        self._entries = OrderedDict()
+
+        self._encoder = None
+        if SentenceTransformer is not None:
+            try:
+                self._encoder = SentenceTransformer(LLM_CACHE_EMBEDDING_MODEL)
+                dim = self._encoder.get_sentence_embedding_dimension()
+                self._embeddings = np.zeros((max_entries, dim), dtype=np.float32)
+                self._occupied = np.zeros(max_entries, dtype=bool)
+                self._slot_keys = [None] * max_entries
+                self._free_slots = list(range(max_entries - 1, -1, -1))
+                logger.info(f"Semantic cache enabled with {LLM_CACHE_EMBEDDING_MODEL}")
+            except Exception as e:
+                self._encoder = None
+                logger.warning(f"Failed to load embedding model, semantic cache disabled: {e}")
+
+    @staticmethod
+    def _normalize(message):
+        return message.lower().strip()
+
+    def _key(self, message):
+        return hashlib.blake2b(self._normalize(message).encode()).hexdigest()
+
+    def _embed(self, message):
+        return self._encoder.encode(self._normalize(message), normalize_embeddings=True).astype(np.float32)
+
+    def _evict(self, key):
+        """Remove an entry and release its embedding slot. Caller holds the lock."""
+        _, _, slot = self._entries.pop(key)
+        if slot is not None:
+            self._occupied[slot] = False
+            self._slot_keys[slot] = None
+            self._free_slots.append(slot)
+
+    def _lookup(self, key, now):
+        """Return a live entry's response and mark it recently used. Caller holds the lock."""
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry[0] <= now:
+            self._evict(key)
+            return None
+        self._entries.move_to_end(key)
+        return entry[1]
+
+    def get(self, message):
+        """Return the cached response for message, or None on a miss"""
+        return self.lookup(message)[0]
+
+    def lookup(self, message):
+        """Return (cached response or None, query embedding or None)
+
+        On a miss, pass the embedding to put() so the message isn't encoded twice.
+        """
+        now = time.time()
+        with self._lock:
+            response = self._lookup(self._key(message), now)
+        if response is not None or self._encoder is None:
+            return response, None
+
+        query = self._embed(message)
+        with self._lock:
+            if not self._entries:
+                return None, query
+            # Embeddings are unit length, so one matrix-vector product yields the
+            # cosine similarity against every cached message at once.
+            similarities = np.where(self._occupied, self._embeddings @ query, -1.0)
+            best = int(np.argmax(similarities))
+            if similarities[best] <= self.similarity_threshold:
+                return None, query
+            return self._lookup(self._slot_keys[best], now), query
+
+    def put(self, message, response, embedding=None):
+        """Cache response for message, evicting the least recently used entry when full"""
+        if self.max_entries <= 0:
+            return
+        key = self._key(message)
+        if self._encoder is None:
+            embedding = None
+        elif embedding is None:
+            embedding = self._embed(message)
+        with self._lock:
+            if key in self._entries:
+                self._evict(key)
+            while len(self._entries) >= self.max_entries:
+                self._evict(next(iter(self._entries)))
+
+            slot = None
+            if embedding is not None:
+                slot = self._free_slots.pop()
+                self._embeddings[slot] = embedding
+                self._occupied[slot] = True
+                self._slot_keys[slot] = key
+            self._entries[key] = (time.time() + self.ttl_seconds, response, slot)
+
+    def clear(self):
+        with self._lock:
+            for key in list(self._entries):
+                self._evict(key)
+
+    def __len__(self):
+        return len(self._entries)
+
+class ChannelPool(object):
+    """Round-robin pool of gRPC channels to the email service.
+
+    Spreading calls over several HTTP/2 connections avoids head-of-line
+    blocking and flow-control contention on a single connection.
+    """
+
+    def __init__(self, addr, pool_size=4):
+        if pool_size < 1:
+            raise ValueError(f"Email channel pool size must be at least 1, got {pool_size}")
+        # Use a local subchannel pool so each channel gets its own connection
+        # instead of sharing the process-wide subchannel.
+        self.channels = [
+            grpc.insecure_channel(addr, options=GRPC_CLIENT_OPTIONS + [("grpc.use_local_subchannel_pool", 1)])
+            for _ in range(pool_size)
+        ]
+        self.stubs = [demo_pb2_grpc.EmailServiceStub(channel) for channel in self.channels]
+        self._idx = 0
+        self._lock = threading.Lock()
+
+    def next_stub(self):
+        """Return the next email service stub in round-robin order"""
+        with self._lock:
+            self._idx = (self._idx + 1) % len(self.stubs)
+            return self.stubs[self._idx]
 
 class ChatbotService(demo_pb2_grpc.ChatbotServiceServicer):
-    def __init__(self):
-        # Initialize Gemini AI if API key is available
+    def __init__(self, gemini_api_key=None):
+        # Initialize Gemini AI if API key is available; an explicit key
+        # (including '' for none) takes precedence over GEMINI_API_KEY
         self.gemini_model = None
-        gemini_api_key = os.environ.get('GEMINI_API_KEY')
+        if gemini_api_key is None:
+            gemini_api_key = os.environ.get('GEMINI_API_KEY')
         if gemini_api_key:
             try:
+                _ensure_genai()
                 genai.configure(api_key=gemini_api_key)
-                self.gemini_model = genai.GenerativeModel('gemini-2.0-flash')
+                self.gemini_model = genai.GenerativeModel('gemini-2.0-flash', system_instruction=CHAT_SYSTEM_PROMPT)
                 logger.info("Gemini AI initialized successfully for chatbot")
             except Exception as e:
                 logger.warning(f"Failed to initialize Gemini AI: {e}")
         else:
             logger.info("GEMINI_API_KEY not set, using fallback responses")
 
+        # Per-process sequence so tickets created in the same second get distinct IDs
+        self._ticket_counter = itertools.count(1)
+
+        # Cache Gemini responses so repeated questions skip the model round-trip.
+        # Only the exact-match tier is active in the shipped image: the semantic
+        # tier needs sentence-transformers, which requirements.txt doesn't include.
+        self.response_cache = SemanticCache()
+
         # Initialize email service connection
+        self.email_pool = None
         self.email_service_addr = os.environ.get('EMAIL_SERVICE_ADDR', '')
         if self.email_service_addr:
-            self.email_channel = grpc.insecure_channel(self.email_service_addr)
-            self.email_stub = demo_pb2_grpc.EmailServiceStub(self.email_channel)
-            logger.info(f"Connected to email service at {self.email_service_addr}")
+            pool_size = int(os.environ.get('EMAIL_CHANNEL_POOL_SIZE', 4))
+            self.email_pool = ChannelPool(self.email_service_addr, pool_size)
+            logger.info(f"Connected to email service at {self.email_service_addr} with {pool_size} channels")
 
     def _get_ai_response(self, user_message, context=None):
         """Get AI-powered response using Gemini"""
         if not self.gemini_model:
             return self._get_fallback_response(user_message)
+
+        cached_response, embedding = self.response_cache.lookup(user_message)
+        if cached_response is not None:
+            return cached_response
         
         try:
-            # Create context-aware prompt
-            system_prompt = """
-            You are a helpful customer support agent for Online Boutique, an e-commerce platform.
-            You help customers with:
-            - Product inquiries
-            - Order status and tracking
-            - Returns and refunds
-            - Account issues
-            - General shopping assistance
-            
-            Be friendly, professional, and concise. If you cannot help with something,
-            politely direct them to contact human support.
-            """
-            
-            full_prompt = f"{system_prompt}\n\nCustomer: {user_message}\n\nAssistant:"
-            
-            response = self.gemini_model.generate_content(full_prompt)
-            return response.text.strip()
+            response = self.gemini_model.generate_content(user_message)
+            bot_response = response.text.strip()
+            self.response_cache.put(user_message, bot_response, embedding)
+            return bot_response
                 
         except Exception as e:
             logger.warning(f"Gemini AI chat failed: {e}")
             return self._get_fallback_response(user_message)
 
+    def _stream_ai_response(self, user_message):
+        """Yield the Gemini response in chunks as they are generated"""
+        if not self.gemini_model:
+            yield self._get_fallback_response(user_message)
+            return
+
+        cached_response, embedding = self.response_cache.lookup(user_message)
+        if cached_response is not None:
+            yield cached_response
+            return
+
+        chunks = []
+        try:
+            for chunk in self.gemini_model.generate_content(user_message, stream=True):
+                # Finish-reason or safety chunks carry no parts, and .text raises on them
+                if chunk.parts and chunk.text:
+                    chunks.append(chunk.text)
+                    yield chunk.text
+        except Exception as e:
+            logger.warning(f"Gemini AI chat stream failed: {e}")
+            # Part of the reply is already out, so a fallback can't replace it;
+            # let the caller report the failure instead of ending the stream cleanly
+            if chunks:
+                raise
+            yield self._get_fallback_response(user_message)
+            return
+
+        self.response_cache.put(user_message, "".join(chunks).strip(), embedding)
+
     def _get_fallback_response(self, user_message):
         """Fallback responses when AI is not available"""
+        # Intents are in priority order; each keyword test is a single C-level
+        # substring search, which beats a regex scan for a handful of keywords
         message_lower = user_message.lower()
-        
-        if any(word in message_lower for word in ['order', 'tracking', 'status']):
-            return "I can help you track your order! Please provide your order number and I'll look it up for you."
-        elif any(word in message_lower for word in ['return', 'refund', 'exchange']):
-            return "For returns and refunds, please visit our returns page or contact our support team. We're happy to help!"
-        elif any(word in message_lower for word in ['product', 'item', 'availability']):
-            return "I can help you find products! What are you looking for today?"
-        elif any(word in message_lower for word in ['shipping', 'delivery']):
-            return "We offer various shipping options. Standard delivery is 3-5 business days, and express is 1-2 days."
-        else:
-            return "Thank you for contacting Online Boutique support! How can I help you today?"
+        for keywords, response in FALLBACK_INTENTS:
+            for keyword in keywords:
+                if keyword in message_lower:
+                    return response
+        return FALLBACK_DEFAULT_RESPONSE
 
     def SendChatMessage(self, request, context):
         """Handle chat messages from customers"""
         try:
             user_message = request.message
-            user_id = getattr(request, 'user_id', 'anonymous')
-            
-            logger.info(f"[Chat] User {user_id}: {user_message}")
+            user_id = request.user_id or 'anonymous'
             
             # Get AI response
             bot_response = self._get_ai_response(user_message)
             
-            logger.info(f"[Chat] Bot response: {bot_response}")
+            logger.info("[Chat] chat_turn", extra={
+                'user_id': user_id, 'user_message': user_message, 'bot_response': bot_response})
             
             # Build response
             response = demo_pb2.ChatResponse()
@@ -160,22 +402,43 @@ class ChatbotService(demo_pb2_grpc.ChatbotServiceServicer):
             context.set_details(f"Chat service error: {str(e)}")
             return demo_pb2.ChatResponse()
 
+    def StreamChatMessage(self, request, context):
+        """Stream the reply to a chat message as it is generated"""
+        user_message = request.message
+        user_id = request.user_id or 'anonymous'
+        chunks = []
+        try:
+            for chunk in self._stream_ai_response(user_message):
+                chunks.append(chunk)
+                yield demo_pb2.ChatResponse(message=chunk, timestamp=int(time.time()))
+
+            logger.info("[Chat Stream] chat_turn", extra={
+                'user_id': user_id, 'user_message': user_message, 'bot_response': "".join(chunks)})
+
+        except Exception as e:
+            logger.error(f"Error in chat stream: {e}")
+            context.set_code(grpc.StatusCode.INTERNAL)
+            context.set_details(f"Chat service error: {str(e)}")
+
+    def _new_ticket_id(self):
+        return f"TICKET-{int(time.time())}-{next(self._ticket_counter):06d}"
+
     def SendSupportTicket(self, request, context):
         """Handle support ticket creation and send email notification"""
         try:
-            ticket_id = f"TICKET-{int(time.time())}"
+            ticket_id = self._new_ticket_id()
             
             # Log the support ticket
             logger.info(f"[Support Ticket] {ticket_id}: {request.subject}")
             
             # Send email notification if email service is available
-            if hasattr(self, 'email_stub'):
+            if self.email_pool:
                 try:
                     email_request = demo_pb2.SendOrderConfirmationRequest()
                     email_request.email = request.email
                     email_request.order.order_id = ticket_id
                     
-                    self.email_stub.SendOrderConfirmation(email_request)
+                    self.email_pool.next_stub().SendOrderConfirmation(email_request)
                     logger.info(f"Support ticket notification sent to {request.email}")
                 except Exception as e:
                     logger.warning(f"Failed to send email notification: {e}")
@@ -218,12 +481,11 @@ def http_chat():
         user_message = data['message']
         user_id = data.get('user_id', 'anonymous')
         
-        logger.info(f"[HTTP Chat] User {user_id}: {user_message}")
-        
         # Get AI response using the same logic as gRPC
         bot_response = chatbot_service._get_ai_response(user_message)
         
-        logger.info(f"[HTTP Chat] Bot response: {bot_response}")
+        logger.info("[HTTP Chat] chat_turn", extra={
+            'user_id': user_id, 'user_message': user_message, 'bot_response': bot_response})
         
         return jsonify({
             'message': bot_response,
@@ -234,6 +496,31 @@ def http_chat():
         logger.error(f"Error in HTTP chat: {e}")
         return jsonify({'error': str(e)}), 500
 
+@app.route('/chat/stream', methods=['POST'])
+def http_chat_stream():
+    """HTTP endpoint streaming the chat reply as server-sent events"""
+    data = request.get_json(silent=True)
+    if not data or 'message' not in data:
+        return jsonify({'error': 'Message is required'}), 400
+
+    user_message = data['message']
+    user_id = data.get('user_id', 'anonymous')
+
+    def events():
+        chunks = []
+        try:
+            for chunk in chatbot_service._stream_ai_response(user_message):
+                chunks.append(chunk)
+                yield "data: " + json.dumps({'message': chunk, 'timestamp': int(time.time())}) + "\n\n"
+
+            logger.info("[HTTP Chat Stream] chat_turn", extra={
+                'user_id': user_id, 'user_message': user_message, 'bot_response': "".join(chunks)})
+        except Exception as e:
+            logger.error(f"Error in HTTP chat stream: {e}")
+            yield "event: error\ndata: " + json.dumps({'error': str(e)}) + "\n\n"
+
+    return Response(stream_with_context(events()), mimetype='text/event-stream')
+
 @app.route('/health', methods=['GET'])
 def http_health():
     """HTTP health check endpoint"""
@@ -247,18 +534,18 @@ def http_support_ticket():
         if not data or 'subject' not in data:
             return jsonify({'error': 'Subject is required'}), 400
         
-        ticket_id = f"TICKET-{int(time.time())}"
+        ticket_id = chatbot_service._new_ticket_id()
         
         logger.info(f"[HTTP Support Ticket] {ticket_id}: {data['subject']}")
         
         # Send email notification if email service is available
-        if hasattr(chatbot_service, 'email_stub'):
+        if chatbot_service.email_pool:
             try:
                 email_request = demo_pb2.SendOrderConfirmationRequest()
                 email_request.email = data.get('email', '')
                 email_request.order.order_id = ticket_id
                 
-                chatbot_service.email_stub.SendOrderConfirmation(email_request)
+                chatbot_service.email_pool.next_stub().SendOrderConfirmation(email_request)
                 logger.info(f"Support ticket notification sent to {data.get('email', '')}")
             except Exception as e:
                 logger.warning(f"Failed to send email notification: {e}")
@@ -275,7 +562,11 @@ def http_support_ticket():
 
 def start_http_server():
     """Start the HTTP server in a separate thread"""
-    app.run(host='0.0.0.0', port=8081, debug=False, use_reloader=False)
+    # Serve with waitress rather than the single-threaded Werkzeug dev server so
+    # concurrent /chat requests don't queue behind each other's Gemini calls.
+    # A single process keeps chatbot_service and its response cache shared.
+    threads = int(os.environ.get('HTTP_THREADS', 32))
+    serve(app, host='0.0.0.0', port=8081, threads=threads)
 
 if __name__ == "__main__":
     logger.info("initializing chatbotservice")
@@ -283,14 +574,11 @@ if __name__ == "__main__":
     # Declare global variable at the start
     global chatbot_service
 
-    try:
-        if "DISABLE_PROFILER" in os.environ:
-            raise KeyError()
-        else:
-            logger.info("Profiler enabled.")
-            initStackdriverProfiling()
-    except KeyError:
+    if "DISABLE_PROFILER" in os.environ:
         logger.info("Profiler disabled.")
+    else:
+        logger.info("Profiler enabled.")
+        initStackdriverProfiling()
 
     try:
         grpc_client_instrumentor = GrpcInstrumentorClient()
@@ -315,8 +603,13 @@ if __name__ == "__main__":
 
     port = os.environ.get('PORT', "8080")
 
-    # create gRPC server
-    server = grpc.server(futures.ThreadPoolExecutor(max_workers=10))
+    # create gRPC server; handlers spend most of their time waiting on Gemini,
+    # so size the executor for I/O-bound work rather than for CPU count
+    max_workers = int(os.environ.get('GRPC_MAX_WORKERS', min(256, 32 * (os.cpu_count() or 1))))
+    server = grpc.server(
+        futures.ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='grpc-exec'),
+        maximum_concurrent_rpcs=max_workers * 4,
+        options=GRPC_SERVER_OPTIONS)
 
     # add class to gRPC server
     service = ChatbotService()
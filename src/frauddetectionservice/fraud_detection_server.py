@@ -18,15 +18,17 @@ import os
 import time
 import traceback
 from concurrent import futures
+import itertools
 import json
 import re
-from datetime import datetime, timedelta
-from collections import defaultdict
+import threading
+from datetime import MAXYEAR, MINYEAR, datetime
+from functools import lru_cache
+from collections import OrderedDict, defaultdict, deque
 
 import googlecloudprofiler
 from google.auth.exceptions import DefaultCredentialsError
 import grpc
-import google.generativeai as genai
 
 import demo_pb2
 import demo_pb2_grpc
@@ -42,12 +44,97 @@ from opentelemetry.exporter.otlp.proto.grpc.trace_exporter import OTLPSpanExport
 from logger import getJSONLogger
 logger = getJSONLogger('frauddetectionservice-server')
 
+# The Gemini SDK is imported on first use so that processes running without
+# GEMINI_API_KEY (including test runs) skip its start-up cost.
+genai = None
+
+def _ensure_genai():
+    global genai
+    if genai is None:
+        import google.generativeai as _genai
+        genai = _genai
+
+LLM_CACHE_TTL_SECONDS = int(os.environ.get('LLM_CACHE_TTL_SECONDS', 3600))
+LLM_CACHE_MAX_ENTRIES = int(os.environ.get('LLM_CACHE_MAX_ENTRIES', 10000))
+AI_ASSESSMENT_TIMEOUT_SECONDS = float(os.environ.get('AI_ASSESSMENT_TIMEOUT_SECONDS', 2.0))
+
+# Handlers spend most of their time waiting on Gemini, so size the RPC
+# executor for I/O-bound work rather than for CPU count. The AI assessment
+# pool matches it so every in-flight RPC can have its assessment running.
+GRPC_MAX_WORKERS = int(os.environ.get('GRPC_MAX_WORKERS', min(256, 32 * (os.cpu_count() or 1))))
+AI_ASSESSMENT_MAX_WORKERS = int(os.environ.get('AI_ASSESSMENT_MAX_WORKERS', GRPC_MAX_WORKERS))
+
+# HTTP/2 tuning so each client connection can carry many in-flight RPCs
+GRPC_SERVER_OPTIONS = [
+    ("grpc.max_concurrent_streams", 1000),
+    ("grpc.http2.max_frame_size", 1048576),
+    ("grpc.keepalive_time_ms", 30000),
+    ("grpc.keepalive_timeout_ms", 10000),
+    ("grpc.http2.min_time_between_pings_ms", 10000),
+    ("grpc.http2.min_ping_interval_without_data_ms", 10000),
+    ("grpc.http2.max_pings_without_data", 0),
+    ("grpc.so_reuseport", 1),
+]
+
+# Sent once as the model's system instruction; each request only carries the
+# transaction fields below
+FRAUD_SYSTEM_PROMPT = """You analyze payment transactions for fraud risk.
+
+Consider these fraud indicators:
+- Unusual amounts or patterns
+- Time-based anomalies
+- Geographic inconsistencies
+- Velocity patterns
+
+Return a fraud risk score from 0.0 (no risk) to 1.0 (high risk) and a brief explanation.
+Format: SCORE:0.X|REASON:explanation"""
+
+FRAUD_PROMPT_TEMPLATE = """Amount: ${amount:.2f}
+Currency: {currency}
+Card Type: {card_type}
+Transaction Time: {timestamp}
+User Pattern: {user_pattern}"""
+
+# Gemini replies as SCORE:0.X|REASON:explanation; the reason may span lines
+_AI_RE = re.compile(r'SCORE:\s*([-\d.]+)\s*\|\s*REASON:(.*)', re.S)
+
+# Common fraud amounts, compared in whole cents to avoid float equality
+_SUSPICIOUS_AMOUNTS = frozenset({9999.99, 5000.00, 1000.00, 2500.00, 7500.00})
+_SUSPICIOUS_CENTS = frozenset(int(round(a * 100)) for a in _SUSPICIOUS_AMOUNTS)
+
+# Luhn lookup tables indexed by byte value. The first 256 entries hold the
+# digit value and the next 256 the doubled digit (minus 9 when above 9); any
+# byte that is not an ASCII digit maps to 0 and does not advance the position.
+_LUHN_DOUBLED = (0, 2, 4, 6, 8, 1, 3, 5, 7, 9)
+_LUHN_TABLE = (
+    bytes(c - 48 if 48 <= c <= 57 else 0 for c in range(256)) +
+    bytes(_LUHN_DOUBLED[c - 48] if 48 <= c <= 57 else 0 for c in range(256))
+)
+_IS_DIGIT = bytes(1 if 48 <= c <= 57 else 0 for c in range(256))
+
+def _luhn_digits(buf):
+    """Return (digit count, Luhn sum) over the ASCII digits in buf, skipping other bytes"""
+    total = 0
+    count = 0
+    for c in reversed(buf):
+        total += _LUHN_TABLE[((count & 1) << 8) | c]
+        count += _IS_DIGIT[c]
+    return count, total
+
+@lru_cache(maxsize=1)
+def _year_month(minute):
+    """Local (year, month) for a minute since the epoch"""
+    return time.localtime(minute * 60)[:2]
+
+def _current_year_month():
+    """Local (year, month), recomputed at most once a minute"""
+    return _year_month(int(time.time()) // 60)
+
 def initStackdriverProfiling():
-    project_id = None
-    try:
-        project_id = os.environ["GCP_PROJECT_ID"]
-    except KeyError:
-        pass
+    if "DISABLE_PROFILER" in os.environ:
+        return
+
+    project_id = os.environ.get("GCP_PROJECT_ID")
 
     for retry in range(1,4):
         try:
@@ -57,24 +144,118 @@ def initStackdriverProfiling():
                 googlecloudprofiler.start(service='fraud_detection_server', service_version='1.0.0', verbose=0)
             logger.info("Successfully started Stackdriver Profiler.")
             return
+        except ImportError as exc:
+            logger.warning("Stackdriver Profiler agent is not available, not retrying. " + str(exc))
+            return
         except (BaseException) as exc:
             logger.info("Unable to start Stackdriver Profiler Python agent. " + str(exc))
-            if (retry < 4):
-                logger.info("Sleeping %d seconds to retry Stackdriver Profiler agent initialization"%(retry*10))
-                time.sleep (1)
+            if (retry < 3):
+                delay = min(30, 2 ** retry)
+                logger.info("Sleeping %d seconds to retry Stackdriver Profiler agent initialization"%(delay))
+                time.sleep(delay)
             else:
                 logger.warning("Could not initialize Stackdriver Profiler after retrying, giving up")
-    return
+
+class AssessmentCache(object):
+    """Thread-safe LRU cache with per-entry TTL for AI fraud assessments"""
+
+    def __init__(self, max_entries=LLM_CACHE_MAX_ENTRIES, ttl_seconds=LLM_CACHE_TTL_SECONDS):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._lock = threading.Lock()
+        # key -> (expires_at, value)
+        self._entries = OrderedDict()
+
+    def get(self, key):
+        """Return the cached value for key, or None on a miss"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] <= time.time():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return entry[1]
+
+    def put(self, key, value):
+        """Cache value under key, evicting the least recently used entry when full"""
+        if self.max_entries <= 0:
+            return
+        with self._lock:
+            self._entries.pop(key, None)
+            while len(self._entries) >= self.max_entries:
+                self._entries.popitem(last=False)
+            self._entries[key] = (time.time() + self.ttl_seconds, value)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+class TransactionWindow(object):
+    """Time-ordered (monotonic timestamp, amount) pairs with a running total of the amounts
+
+    Wraps a deque rather than subclassing it, so only operations that keep
+    the total in sync are available.
+    """
+
+    def __init__(self, iterable=()):
+        self._items = deque()
+        self.total = 0.0
+        self.extend(iterable)
+
+    def __len__(self):
+        return len(self._items)
+
+    def append(self, item):
+        self._items.append(item)
+        self.total += item[1]
+
+    def extend(self, items):
+        items = list(items)
+        self._items.extend(items)
+        self.total += sum(amount for _, amount in items)
+
+    def remove(self, item):
+        self._items.remove(item)
+        self.total = self.total - item[1] if self._items else 0.0
+
+    def clear(self):
+        self._items.clear()
+        self.total = 0.0
+
+    def expire(self, cutoff):
+        """Drop transactions at or before cutoff"""
+        items = self._items
+        while items and items[0][0] <= cutoff:
+            self.total -= items.popleft()[1]
+        if not items:
+            self.total = 0.0  # Don't let float error accumulate across an emptied window
+
+    def count_since(self, cutoff):
+        """Count transactions after cutoff, scanning back from the newest"""
+        count = 0
+        for ts, _ in reversed(self._items):
+            if ts <= cutoff:
+                break
+            count += 1
+        return count
 
 class FraudDetectionService(demo_pb2_grpc.FraudDetectionServiceServicer):
-    def __init__(self):
-        # Initialize Gemini AI if API key is available
+    def __init__(self, gemini_api_key=None):
+        # Initialize Gemini AI if API key is available; an explicit key
+        # (including '' for none) takes precedence over GEMINI_API_KEY
         self.gemini_model = None
-        gemini_api_key = os.environ.get('GEMINI_API_KEY')
+        if gemini_api_key is None:
+            gemini_api_key = os.environ.get('GEMINI_API_KEY')
         if gemini_api_key:
             try:
+                _ensure_genai()
                 genai.configure(api_key=gemini_api_key)
-                self.gemini_model = genai.GenerativeModel('gemini-pro')
+                self.gemini_model = genai.GenerativeModel('gemini-2.0-flash', system_instruction=FRAUD_SYSTEM_PROMPT)
                 logger.info("Gemini AI initialized successfully for fraud detection")
             except Exception as e:
                 logger.warning(f"Failed to initialize Gemini AI: {e}")
@@ -82,9 +263,25 @@ class FraudDetectionService(demo_pb2_grpc.FraudDetectionServiceServicer):
             logger.info("GEMINI_API_KEY not set, using rule-based fraud detection only")
 
         # In-memory storage for transaction patterns (in production, use Redis/database)
-        self.transaction_history = defaultdict(list)
+        # Each user's history covers the last 24 hours and keeps a running total.
+        # Users are spread over lock-striped shards so concurrent checks for
+        # different users rarely contend. A check for one user records its
+        # transaction in the same critical section as the velocity check, so
+        # concurrent checks for that user each see the others.
+        self._shards = [
+            {"lock": threading.Lock(), "hist": defaultdict(TransactionWindow)}
+            for _ in range(64)
+        ]
         self.user_patterns = defaultdict(dict)
         
+        # Transactions with the same coarse profile get the same AI verdict
+        self.assessment_cache = AssessmentCache()
+        # Runs the AI assessment while the local checks execute on the RPC thread
+        self._aux_pool = futures.ThreadPoolExecutor(
+            max_workers=AI_ASSESSMENT_MAX_WORKERS, thread_name_prefix='fraud-aux')
+        # Number of AI verdicts dropped because the assessment timed out
+        self._ai_timeouts = itertools.count(1)
+        
         # Fraud detection thresholds
         self.max_amount_threshold = 10000.0  # $10,000
         self.velocity_threshold = 5  # Max 5 transactions per minute
@@ -95,71 +292,76 @@ class FraudDetectionService(demo_pb2_grpc.FraudDetectionServiceServicer):
         if not credit_card or not credit_card.credit_card_number:
             return False, "Missing credit card number"
         
-        # Remove spaces and non-digits
-        card_number = re.sub(r'\D', '', credit_card.credit_card_number)
+        # Spaces and other separators are skipped by the lookup tables
+        digit_count, luhn_sum = _luhn_digits(credit_card.credit_card_number.encode())
         
         # Check length
-        if len(card_number) < 13 or len(card_number) > 19:
+        if digit_count < 13 or digit_count > 19:
             return False, "Invalid credit card number length"
         
-        # Luhn algorithm
-        def luhn_check(card_num):
-            digits = [int(d) for d in card_num]
-            for i in range(len(digits) - 2, -1, -2):
-                digits[i] *= 2
-                if digits[i] > 9:
-                    digits[i] -= 9
-            return sum(digits) % 10 == 0
-        
-        if not luhn_check(card_number):
+        if luhn_sum % 10 != 0:
             return False, "Invalid credit card number"
         
-        # Check expiry date
-        try:
-            exp_month = credit_card.credit_card_expiration_month
-            exp_year = credit_card.credit_card_expiration_year
-            
-            if exp_month < 1 or exp_month > 12:
-                return False, "Invalid expiration month"
-            
-            current_date = datetime.now()
-            exp_date = datetime(exp_year, exp_month, 1)
-            
-            if exp_date < current_date:
-                return False, "Credit card expired"
-                
-        except (ValueError, AttributeError):
-            return False, "Invalid expiration date"
+        # Check expiry date; a card is valid through the end of its expiry month
+        exp_month = credit_card.credit_card_expiration_month
+        exp_year = credit_card.credit_card_expiration_year
         
-        return True, "Valid"
-
-    def _check_velocity_fraud(self, user_id, amount):
-        """Check for velocity-based fraud patterns"""
-        current_time = time.time()
+        if exp_month < 1 or exp_month > 12:
+            return False, "Invalid expiration month"
         
-        # Clean old transactions (older than 1 minute)
-        self.transaction_history[user_id] = [
-            (ts, amt) for ts, amt in self.transaction_history[user_id]
-            if current_time - ts < 60
-        ]
+        # The range datetime accepts, as when expiry was checked via datetime()
+        if exp_year < MINYEAR or exp_year > MAXYEAR:
+            return False, "Invalid expiration date"
         
-        # Check transaction velocity
-        recent_transactions = len(self.transaction_history[user_id])
-        if recent_transactions >= self.velocity_threshold:
-            return True, f"Too many transactions: {recent_transactions} in last minute"
+        if (exp_year, exp_month) < _current_year_month():
+            return False, "Credit card expired"
         
-        # Check daily spending
-        daily_cutoff = current_time - (24 * 3600)
-        daily_spending = sum(
-            amt for ts, amt in self.transaction_history[user_id]
-            if ts > daily_cutoff
-        ) + amount
+        return True, "Valid"
+
+    def _shard(self, user_id):
+        return self._shards[hash(user_id) & 63]
+
+    def _history(self, user_id):
+        """Return the transaction window for user_id; callers hold the shard lock"""
+        return self._shard(user_id)["hist"][user_id]
+
+    def _check_velocity_fraud(self, user_id, amount, record=None):
+        """Check for velocity-based fraud patterns
+
+        When record is a (timestamp, amount) entry and the check passes, it is
+        added to the user's history before the shard lock is released.
+        """
+        # Monotonic time so wall-clock adjustments can't shift the windows
+        current_time = time.monotonic()
         
-        if daily_spending > self.daily_limit:
-            return True, f"Daily spending limit exceeded: ${daily_spending:.2f}"
+        shard = self._shard(user_id)
+        with shard["lock"]:
+            history = shard["hist"][user_id]
+            
+            # Clean old transactions (older than 1 day)
+            history.expire(current_time - (24 * 3600))
+            
+            # Check transaction velocity
+            recent_transactions = history.count_since(current_time - 60)
+            if recent_transactions >= self.velocity_threshold:
+                return True, f"Too many transactions: {recent_transactions} in last minute"
+            
+            # Check daily spending
+            daily_spending = history.total + amount
+            if daily_spending > self.daily_limit:
+                return True, f"Daily spending limit exceeded: ${daily_spending:.2f}"
+            
+            if record is not None:
+                history.append(record)
         
         return False, "Velocity check passed"
 
+    def _discard_transaction(self, user_id, entry):
+        """Drop an entry recorded by _check_velocity_fraud for a transaction that was blocked"""
+        shard = self._shard(user_id)
+        with shard["lock"]:
+            shard["hist"][user_id].remove(entry)
+
     def _check_amount_fraud(self, amount):
         """Check for suspicious amounts"""
         if amount <= 0:
@@ -169,53 +371,58 @@ class FraudDetectionService(demo_pb2_grpc.FraudDetectionServiceServicer):
             return True, f"Amount too high: ${amount:.2f}"
         
         # Check for common fraud amounts
-        suspicious_amounts = [9999.99, 5000.00, 1000.00]
-        if amount in suspicious_amounts:
+        if int(round(amount * 100)) in _SUSPICIOUS_CENTS:
             return True, f"Suspicious amount pattern: ${amount:.2f}"
         
         return False, "Amount check passed"
 
+    @staticmethod
+    def _assessment_cache_key(transaction_data):
+        """Bucket a transaction into the coarse profile used for caching AI assessments"""
+        return (
+            round(transaction_data.get('amount', 0), -2),
+            transaction_data.get('currency', 'USD'),
+            transaction_data.get('card_type', 'Unknown'),
+            min(transaction_data.get('recent_transactions', 0), 10),
+        )
+
+    def _parse_ai_assessment(self, response_text):
+        """Parse a SCORE:0.X|REASON:explanation response into (score, reason), or None"""
+        match = _AI_RE.search(response_text)
+        if match:
+            try:
+                score = float(match.group(1))
+                return min(max(score, 0.0), 1.0), match.group(2).strip()
+            except ValueError:
+                pass
+        
+        return None
+
     def _get_ai_fraud_assessment(self, transaction_data):
         """Use AI to assess fraud risk"""
         if not self.gemini_model:
             return 0.0, "AI assessment not available"
         
+        cache_key = self._assessment_cache_key(transaction_data)
+        cached_assessment = self.assessment_cache.get(cache_key)
+        if cached_assessment is not None:
+            return cached_assessment
+        
         try:
-            prompt = f"""
-            Analyze this payment transaction for fraud risk:
-            
-            Amount: ${transaction_data.get('amount', 0):.2f}
-            Currency: {transaction_data.get('currency', 'USD')}
-            Card Type: {transaction_data.get('card_type', 'Unknown')}
-            Transaction Time: {transaction_data.get('timestamp', 'Unknown')}
-            User Pattern: {transaction_data.get('user_pattern', 'New user')}
-            
-            Consider these fraud indicators:
-            - Unusual amounts or patterns
-            - Time-based anomalies
-            - Geographic inconsistencies
-            - Velocity patterns
-            
-            Return a fraud risk score from 0.0 (no risk) to 1.0 (high risk) and a brief explanation.
-            Format: SCORE:0.X|REASON:explanation
-            """
+            prompt = FRAUD_PROMPT_TEMPLATE.format(
+                amount=transaction_data.get('amount', 0),
+                currency=transaction_data.get('currency', 'USD'),
+                card_type=transaction_data.get('card_type', 'Unknown'),
+                timestamp=transaction_data.get('timestamp') or datetime.now().isoformat(),
+                user_pattern=transaction_data.get('user_pattern', 'New user'))
             
             response = self.gemini_model.generate_content(prompt)
-            response_text = response.text.strip()
-            
-            # Parse response
-            if "|" in response_text:
-                parts = response_text.split("|")
-                score_part = parts[0].replace("SCORE:", "").strip()
-                reason_part = parts[1].replace("REASON:", "").strip() if len(parts) > 1 else "AI assessment"
-                
-                try:
-                    score = float(score_part)
-                    return min(max(score, 0.0), 1.0), reason_part
-                except ValueError:
-                    pass
-            
-            return 0.2, "AI assessment completed"
+            assessment = self._parse_ai_assessment(response.text.strip())
+            if assessment is None:
+                # Off-format reply; don't cache it so the next transaction asks again
+                return 0.2, "AI assessment completed"
+            self.assessment_cache.put(cache_key, assessment)
+            return assessment
                 
         except Exception as e:
             logger.warning(f"AI fraud assessment failed: {e}")
@@ -223,14 +430,36 @@ class FraudDetectionService(demo_pb2_grpc.FraudDetectionServiceServicer):
 
     def CheckFraud(self, request, context):
         """Main fraud detection endpoint"""
+        recorded = None
         try:
             # Extract transaction details
             amount = float(request.amount.units + request.amount.nanos / 1e9)
             currency = request.amount.currency_code
             credit_card = request.credit_card
-            user_id = getattr(request, 'user_id', 'anonymous')
+            user_id = request.user_id or 'anonymous'
             
-            logger.info(f"[Fraud Check] User: {user_id}, Amount: ${amount:.2f} {currency}")
+            # Start the AI-based assessment first so the Gemini round-trip
+            # overlaps with the local checks below
+            shard = self._shard(user_id)
+            with shard["lock"]:
+                # History spans 24h for the daily limit; the AI only sees the last minute
+                recent_transactions = shard["hist"][user_id].count_since(time.monotonic() - 60)
+            transaction_data = {
+                'amount': amount,
+                'currency': currency,
+                'card_type': credit_card.credit_card_number[:4] if credit_card.credit_card_number else 'Unknown',
+                'user_pattern': f"{recent_transactions} recent transactions",
+                'recent_transactions': recent_transactions
+            }
+            # Only hop to the AI pool when Gemini will actually be called; without
+            # a model, or for an already assessed profile, answer on this thread
+            ai_future = None
+            if self.gemini_model is None:
+                ai_assessment = (0.0, "AI assessment not available")
+            else:
+                ai_assessment = self.assessment_cache.get(self._assessment_cache_key(transaction_data))
+                if ai_assessment is None:
+                    ai_future = self._aux_pool.submit(self._get_ai_fraud_assessment, transaction_data)
             
             fraud_reasons = []
             risk_score = 0.0
@@ -247,22 +476,28 @@ class FraudDetectionService(demo_pb2_grpc.FraudDetectionServiceServicer):
                 fraud_reasons.append(amount_message)
                 risk_score += 0.6
             
-            # 3. Velocity checks
-            is_velocity_fraud, velocity_message = self._check_velocity_fraud(user_id, amount)
+            # 3. Velocity checks; a transaction not already blocked is recorded
+            # atomically with the check and discarded again if it is blocked later
+            if not fraud_reasons:
+                recorded = (time.monotonic(), amount)
+            is_velocity_fraud, velocity_message = self._check_velocity_fraud(user_id, amount, recorded)
             if is_velocity_fraud:
+                recorded = None
                 fraud_reasons.append(velocity_message)
                 risk_score += 0.7
             
             # 4. AI-based assessment
-            transaction_data = {
-                'amount': amount,
-                'currency': currency,
-                'card_type': credit_card.credit_card_number[:4] if credit_card.credit_card_number else 'Unknown',
-                'timestamp': datetime.now().isoformat(),
-                'user_pattern': f"{len(self.transaction_history[user_id])} recent transactions"
-            }
-            
-            ai_score, ai_reason = self._get_ai_fraud_assessment(transaction_data)
+            if ai_future is None:
+                ai_score, ai_reason = ai_assessment
+            else:
+                try:
+                    ai_score, ai_reason = ai_future.result(timeout=AI_ASSESSMENT_TIMEOUT_SECONDS)
+                except futures.TimeoutError:
+                    # Don't let a queued assessment call Gemini after the RPC has answered
+                    ai_future.cancel()
+                    logger.warning("AI fraud assessment timed out",
+                                   extra={'ai_timeouts': next(self._ai_timeouts)})
+                    ai_score, ai_reason = 0.0, "AI timeout"
             risk_score += ai_score * 0.3  # Weight AI assessment at 30%
             
             # Normalize risk score
@@ -271,9 +506,9 @@ class FraudDetectionService(demo_pb2_grpc.FraudDetectionServiceServicer):
             # Determine if transaction should be blocked
             is_fraud = risk_score > 0.7 or len(fraud_reasons) > 0
             
-            if not is_fraud:
-                # Record successful transaction
-                self.transaction_history[user_id].append((time.time(), amount))
+            if is_fraud and recorded is not None:
+                self._discard_transaction(user_id, recorded)
+                recorded = None
             
             # Build response
             response = demo_pb2.FraudCheckResponse()
@@ -281,12 +516,16 @@ class FraudDetectionService(demo_pb2_grpc.FraudDetectionServiceServicer):
             response.risk_score = risk_score
             response.reason = "; ".join(fraud_reasons) if fraud_reasons else ai_reason
             
-            logger.info(f"[Fraud Result] Fraud: {is_fraud}, Score: {risk_score:.2f}, Reason: {response.reason}")
+            logger.info("[Fraud Check] fraud_check", extra={
+                'user_id': user_id, 'amount': round(amount, 2), 'currency': currency,
+                'is_fraud': is_fraud, 'risk_score': round(risk_score, 2), 'reason': response.reason})
             
             return response
             
         except Exception as e:
             logger.error(f"Error in fraud detection: {e}")
+            if recorded is not None:
+                self._discard_transaction(user_id, recorded)
             context.set_code(grpc.StatusCode.INTERNAL)
             context.set_details(f"Fraud detection error: {str(e)}")
             
@@ -309,14 +548,11 @@ class FraudDetectionService(demo_pb2_grpc.FraudDetectionServiceServicer):
 if __name__ == "__main__":
     logger.info("initializing frauddetectionservice")
 
-    try:
-        if "DISABLE_PROFILER" in os.environ:
-            raise KeyError()
-        else:
-            logger.info("Profiler enabled.")
-            initStackdriverProfiling()
-    except KeyError:
+    if "DISABLE_PROFILER" in os.environ:
         logger.info("Profiler disabled.")
+    else:
+        logger.info("Profiler enabled.")
+        initStackdriverProfiling()
 
     try:
         grpc_client_instrumentor = GrpcInstrumentorClient()
@@ -342,7 +578,11 @@ if __name__ == "__main__":
     port = os.environ.get('PORT', "8080")
 
     # create gRPC server
-    server = grpc.server(futures.ThreadPoolExecutor(max_workers=10))
+    max_workers = GRPC_MAX_WORKERS
+    server = grpc.server(
+        futures.ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='grpc-exec'),
+        maximum_concurrent_rpcs=max_workers * 4,
+        options=GRPC_SERVER_OPTIONS)
 
     # add class to gRPC server
     service = FraudDetectionService()
@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+#
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Shared pytest fixtures for the AI service tests."""
+
+import io
+import json
+import logging
+import pathlib
+import sys
+import time
+from unittest.mock import MagicMock
+
+import grpc
+import pytest
+
+# Make the service modules importable once per session rather than from
+# every test module. Tests are collected with --import-mode=importlib, which
+# leaves sys.path alone, so the tests directory (where CI generates demo_pb2)
+# is added here as well.
+TESTS = pathlib.Path(__file__).resolve().parent
+ROOT = TESTS.parent
+sys.path[:0] = [str(ROOT / 'src' / 'chatbotservice'), str(ROOT / 'src' / 'frauddetectionservice'), str(TESTS)]
+
+
+@pytest.fixture(autouse=True, scope="session")
+def _mute_logs():
+    """Silence service logging; handlers log every RPC. See json_logs to assert on it."""
+    logging.disable(logging.CRITICAL)
+    yield
+    logging.disable(logging.NOTSET)
+
+
+# Contexts are reset and reused between tests instead of rebuilt;
+# MagicMock construction with a spec is comparatively costly.
+_CTX_POOL = []
+
+
+def borrow_context():
+    """Take a clean servicer context from the pool, creating one if empty."""
+    if _CTX_POOL:
+        context = _CTX_POOL.pop()
+    else:
+        context = MagicMock(spec=grpc.ServicerContext)
+    context.invocation_metadata.return_value = ()
+    return context
+
+
+def return_context(context):
+    """Reset calls and configured behaviour, then hand the context back to the pool."""
+    context.reset_mock(return_value=True, side_effect=True)
+    _CTX_POOL.append(context)
+
+
+@pytest.fixture
+def fake_grpc_context():
+    """Stand-in for the servicer context so handlers can be called directly.
+
+    Tests invoke servicer methods in-process instead of going through a real
+    gRPC server, so no channel, HTTP/2 framing or wire serialization is involved.
+    """
+    context = borrow_context()
+    yield context
+    return_context(context)
+
+
+@pytest.fixture
+def json_logs():
+    """Re-enable logging and capture what a service logger emits, one dict per record.
+
+    Call the fixture with the logger to watch; it returns a callable yielding
+    the records formatted by that logger's own JSON formatter so far.
+    """
+    attached = []
+
+    def capture(logger):
+        stream = io.StringIO()
+        handler = logging.StreamHandler(stream)
+        handler.setFormatter(logger.handlers[0].formatter)
+        logger.addHandler(handler)
+        attached.append((logger, handler))
+        return lambda: [json.loads(line) for line in stream.getvalue().splitlines()]
+
+    logging.disable(logging.NOTSET)
+    yield capture
+    logging.disable(logging.CRITICAL)
+    for logger, handler in attached:
+        logger.removeHandler(handler)
+
+
+@pytest.fixture
+def frozen_time(monkeypatch):
+    """Pin time.monotonic to a mutable cell; tests move the clock by assigning to [0]."""
+    now = [1000.0]
+    monkeypatch.setattr(time, "monotonic", lambda: now[0])
+    return now
+
+
+@pytest.fixture(scope="module")
+def chatbot_service():
+    """One ChatbotService per test module, for tests that do not mutate it."""
+    import chatbot_server
+    return chatbot_server.ChatbotService()
+
+
+@pytest.fixture(scope="module")
+def fraud_service():
+    """One FraudDetectionService per test module, for tests that do not mutate it."""
+    import fraud_detection_server
+    return fraud_detection_server.FraudDetectionService()
@@ -2,26 +2,50 @@
 
 import unittest
 from unittest.mock import Mock, patch, MagicMock
-import sys
 import os
 
-# Add the src directory to the path
-sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src', 'chatbotservice'))
+import grpc
+import pytest
 
 import chatbot_server
 import demo_pb2
 
 class TestChatbotService(unittest.TestCase):
     
+    @pytest.fixture(autouse=True)
+    def _use_fake_context(self, fake_grpc_context):
+        self.context = fake_grpc_context
+    
+    @classmethod
+    def setUpClass(cls):
+        """Build one service for the whole class; tests only reset its state."""
+        cls.shared_service = chatbot_server.ChatbotService()
+        cls._initial_state = dict(cls.shared_service.__dict__)
+        
+        # Request templates; tests copy them and change only what they exercise
+        cls._BASE_CHAT_REQ = demo_pb2.ChatRequest()
+        cls._BASE_CHAT_REQ.message = "Hello"
+        cls._BASE_CHAT_REQ.user_id = "test-user"
+        cls._BASE_TICKET_REQ = demo_pb2.SupportTicketRequest()
+        cls._BASE_TICKET_REQ.email = "test@example.com"
+        cls._BASE_TICKET_REQ.subject = "Test Issue"
+        cls._BASE_TICKET_REQ.message = "I have a problem"
+        cls._BASE_TICKET_REQ.user_id = "test-user"
+    
     def setUp(self):
         """Set up test fixtures before each test method."""
-        self.service = chatbot_server.ChatbotService()
+        self.service = self.shared_service
+        self.service.response_cache.clear()
+    
+    def tearDown(self):
+        """Drop per-test overrides such as mocked methods or models."""
+        self.service.__dict__.clear()
+        self.service.__dict__.update(self._initial_state)
         
     def test_initialization_without_gemini_key(self):
         """Test service initialization without Gemini API key."""
-        with patch.dict(os.environ, {}, clear=True):
-            service = chatbot_server.ChatbotService()
-            self.assertIsNone(service.gemini_model)
+        service = chatbot_server.ChatbotService(gemini_api_key='')
+        self.assertIsNone(service.gemini_model)
     
     @patch('chatbot_server.genai')
     def test_initialization_with_gemini_key(self, mock_genai):
@@ -33,36 +57,29 @@ class TestChatbotService(unittest.TestCase):
             service = chatbot_server.ChatbotService()
             
             mock_genai.configure.assert_called_once_with(api_key='test-key')
-            mock_genai.GenerativeModel.assert_called_once_with('gemini-pro')
+            self.assertEqual(mock_genai.GenerativeModel.call_count, 1)
+            self.assertEqual(mock_genai.GenerativeModel.call_args.args, ('gemini-2.0-flash',))
+            self.assertEqual(mock_genai.GenerativeModel.call_args.kwargs,
+                             {'system_instruction': chatbot_server.CHAT_SYSTEM_PROMPT})
             self.assertEqual(service.gemini_model, mock_model)
     
-    def test_fallback_response_order_query(self):
-        """Test fallback response for order-related queries."""
-        response = self.service._get_fallback_response("What's my order status?")
-        self.assertIn("order", response.lower())
-        self.assertIn("track", response.lower())
-    
-    def test_fallback_response_return_query(self):
-        """Test fallback response for return-related queries."""
-        response = self.service._get_fallback_response("I want to return this item")
-        self.assertIn("return", response.lower())
-    
-    def test_fallback_response_product_query(self):
-        """Test fallback response for product-related queries."""
-        response = self.service._get_fallback_response("Do you have this product?")
-        self.assertIn("product", response.lower())
-    
-    def test_fallback_response_shipping_query(self):
-        """Test fallback response for shipping-related queries."""
-        response = self.service._get_fallback_response("How long does shipping take?")
-        self.assertIn("shipping", response.lower())
-        self.assertIn("delivery", response.lower())
-    
-    def test_fallback_response_general_query(self):
-        """Test fallback response for general queries."""
-        response = self.service._get_fallback_response("Hello")
-        self.assertIn("Online Boutique", response)
-        self.assertIn("help", response.lower())
+    @patch('chatbot_server.time.sleep')
+    @patch('chatbot_server.googlecloudprofiler.start')
+    def test_profiler_retry_backoff(self, mock_start, mock_sleep):
+        """Test profiler start retries back off exponentially."""
+        mock_start.side_effect = RuntimeError("unavailable")
+        with patch.dict(os.environ, {}, clear=True):
+            chatbot_server.initStackdriverProfiling()
+        
+        self.assertEqual(mock_start.call_count, 3)
+        self.assertEqual([c.args[0] for c in mock_sleep.call_args_list], [2, 4])
+    
+    @patch('chatbot_server.googlecloudprofiler.start')
+    def test_profiler_disabled(self, mock_start):
+        """Test the profiler is not started when DISABLE_PROFILER is set."""
+        with patch.dict(os.environ, {'DISABLE_PROFILER': '1'}):
+            chatbot_server.initStackdriverProfiling()
+        mock_start.assert_not_called()
     
     @patch('chatbot_server.time.time')
     def test_send_chat_message_success(self, mock_time):
@@ -72,72 +89,355 @@ class TestChatbotService(unittest.TestCase):
         # Mock the AI response method
         self.service._get_ai_response = Mock(return_value="Hello! How can I help you?")
         
-        # Create request
         request = demo_pb2.ChatRequest()
-        request.message = "Hello"
-        request.user_id = "test-user"
-        
-        # Mock context
-        context = Mock()
+        request.CopyFrom(self._BASE_CHAT_REQ)
         
         # Call the method
-        response = self.service.SendChatMessage(request, context)
+        response = self.service.SendChatMessage(request, self.context)
         
         # Verify response
         self.assertEqual(response.message, "Hello! How can I help you?")
         self.assertEqual(response.timestamp, 1234567890)
     
+    def test_stream_chat_message_chunks(self):
+        """Test streamed replies are sent chunk by chunk and then cached."""
+        mock_model = Mock()
+        mock_model.generate_content.return_value = iter([Mock(text="Hello! "), Mock(text="How can I help?")])
+        self.service.gemini_model = mock_model
+        
+        request = demo_pb2.ChatRequest()
+        request.CopyFrom(self._BASE_CHAT_REQ)
+        
+        responses = list(self.service.StreamChatMessage(request, self.context))
+        
+        self.assertEqual([r.message for r in responses], ["Hello! ", "How can I help?"])
+        self.assertEqual(mock_model.generate_content.call_count, 1)
+        self.assertEqual(mock_model.generate_content.call_args.args, ("Hello",))
+        self.assertEqual(mock_model.generate_content.call_args.kwargs, {'stream': True})
+        self.assertEqual(self.service._get_ai_response("Hello"), "Hello! How can I help?")
+        self.assertEqual(mock_model.generate_content.call_count, 1)
+    
+    def test_stream_chat_message_skips_chunks_without_parts(self):
+        """Test a trailing finish-reason chunk with no parts doesn't fail a delivered reply."""
+        class FinishChunk(object):
+            parts = []
+            
+            @property
+            def text(self):
+                raise ValueError("The `response.text` quick accessor requires a valid `Part`")
+        
+        mock_model = Mock()
+        mock_model.generate_content.return_value = iter([Mock(text="Hello! "), FinishChunk()])
+        self.service.gemini_model = mock_model
+        
+        request = demo_pb2.ChatRequest()
+        request.CopyFrom(self._BASE_CHAT_REQ)
+        
+        responses = list(self.service.StreamChatMessage(request, self.context))
+        
+        self.assertEqual([r.message for r in responses], ["Hello! "])
+        self.assertEqual(self.context.set_code.call_count, 0)
+        self.assertEqual(self.service.response_cache.get("Hello"), "Hello!")
+    
+    def _failing_stream(self):
+        yield Mock(text="Your order ")
+        raise RuntimeError("stream reset")
+    
+    def test_stream_chat_message_failure_mid_stream(self):
+        """Test a Gemini failure after the first chunk is reported through the gRPC status."""
+        mock_model = Mock()
+        mock_model.generate_content.return_value = self._failing_stream()
+        self.service.gemini_model = mock_model
+        
+        request = demo_pb2.ChatRequest()
+        request.CopyFrom(self._BASE_CHAT_REQ)
+        
+        responses = list(self.service.StreamChatMessage(request, self.context))
+        
+        self.assertEqual([r.message for r in responses], ["Your order "])
+        self.context.set_code.assert_called_once_with(grpc.StatusCode.INTERNAL)
+        self.assertIsNone(self.service.response_cache.get("Hello"))
+    
+    def test_http_chat_stream_failure_mid_stream(self):
+        """Test a Gemini failure after the first chunk ends the SSE stream with an error event."""
+        mock_model = Mock()
+        mock_model.generate_content.return_value = self._failing_stream()
+        self.service.gemini_model = mock_model
+        client = chatbot_server.app.test_client()
+        
+        with patch.object(chatbot_server, 'chatbot_service', self.service, create=True):
+            body = client.post('/chat/stream', json={'message': 'Hello'}).get_data(as_text=True)
+        
+        self.assertTrue(body.startswith("data: "))
+        self.assertIn("Your order ", body)
+        self.assertIn("event: error", body)
+    
+    def test_http_chat_stream_events(self):
+        """Test the HTTP streaming endpoint emits server-sent events."""
+        client = chatbot_server.app.test_client()
+        
+        with patch.object(chatbot_server, 'chatbot_service', self.service, create=True):
+            response = client.post('/chat/stream', json={'message': 'Hello'})
+            body = response.get_data(as_text=True)
+        
+        self.assertEqual(response.mimetype, 'text/event-stream')
+        self.assertTrue(body.startswith("data: "))
+        self.assertIn("Online Boutique", body)
+    
+    def test_send_chat_message_error_sets_status(self):
+        """Test chat errors are reported through the gRPC status."""
+        self.service._get_ai_response = Mock(side_effect=RuntimeError("boom"))
+        
+        request = demo_pb2.ChatRequest()
+        request.CopyFrom(self._BASE_CHAT_REQ)
+        
+        response = self.service.SendChatMessage(request, self.context)
+        
+        self.assertEqual(response.message, "")
+        self.context.set_code.assert_called_once_with(grpc.StatusCode.INTERNAL)
+    
     @patch('chatbot_server.time.time')
     def test_send_support_ticket_success(self, mock_time):
         """Test successful support ticket creation."""
         mock_time.return_value = 1234567890
         
-        # Create request
         request = demo_pb2.SupportTicketRequest()
-        request.email = "test@example.com"
-        request.subject = "Test Issue"
-        request.message = "I have a problem"
-        request.user_id = "test-user"
-        
-        # Mock context
-        context = Mock()
+        request.CopyFrom(self._BASE_TICKET_REQ)
         
         # Call the method
-        response = self.service.SendSupportTicket(request, context)
+        response = self.service.SendSupportTicket(request, self.context)
         
         # Verify response
         self.assertEqual(response.status, "created")
         self.assertIn("TICKET-", response.ticket_id)
         self.assertIn("created", response.message)
     
-    @patch('chatbot_server.genai')
-    def test_ai_response_with_gemini(self, mock_genai):
+    @patch('chatbot_server.time.time')
+    def test_support_ticket_ids_unique_within_second(self, mock_time):
+        """Test tickets created in the same second get distinct IDs."""
+        mock_time.return_value = 1234567890
+        
+        request = demo_pb2.SupportTicketRequest()
+        request.CopyFrom(self._BASE_TICKET_REQ)
+        
+        first = self.service.SendSupportTicket(request, self.context)
+        second = self.service.SendSupportTicket(request, self.context)
+        
+        self.assertRegex(first.ticket_id, r"^TICKET-1234567890-\d{6}$")
+        self.assertNotEqual(first.ticket_id, second.ticket_id)
+    
+    @patch('chatbot_server.grpc.insecure_channel')
+    def test_email_channel_pool_round_robin(self, mock_channel):
+        """Test support ticket emails are spread across the channel pool."""
+        with patch.dict(os.environ, {'EMAIL_SERVICE_ADDR': 'emailservice:5000',
+                                     'EMAIL_CHANNEL_POOL_SIZE': '3'}):
+            service = chatbot_server.ChatbotService()
+
+        self.assertEqual(mock_channel.call_count, 3)
+        stubs = [service.email_pool.next_stub() for _ in range(6)]
+        self.assertEqual(len(set(map(id, stubs))), 3)
+        self.assertEqual(stubs[:3], stubs[3:])
+
+    def test_email_channel_pool_rejects_empty_pool(self):
+        """Test a pool size below one fails at startup instead of dropping every email."""
+        with self.assertRaises(ValueError):
+            chatbot_server.ChannelPool('emailservice:5000', pool_size=0)
+    
+    def test_ai_response_with_gemini(self):
         """Test AI response generation with Gemini."""
-        # Setup mock
         mock_model = Mock()
         mock_response = Mock()
         mock_response.text = "AI generated response"
         mock_model.generate_content.return_value = mock_response
+        self.service.gemini_model = mock_model
         
-        with patch.dict(os.environ, {'GEMINI_API_KEY': 'test-key'}):
-            service = chatbot_server.ChatbotService()
-            service.gemini_model = mock_model
-            
-            response = service._get_ai_response("Hello")
-            
-            self.assertEqual(response, "AI generated response")
-            mock_model.generate_content.assert_called_once()
+        response = self.service._get_ai_response("Hello")
+        
+        self.assertEqual(response, "AI generated response")
+        mock_model.generate_content.assert_called_once_with("Hello")
     
     def test_ai_response_fallback(self):
         """Test AI response falls back to rule-based when Gemini unavailable."""
         # Service without Gemini model
-        service = chatbot_server.ChatbotService()
-        service.gemini_model = None
+        self.service.gemini_model = None
         
-        response = service._get_ai_response("Hello")
+        response = self.service._get_ai_response("Hello")
         
         # Should return fallback response
         self.assertIn("Online Boutique", response)
 
-if __name__ == '__main__':
-    unittest.main()
+    def test_ai_response_cache_hit_skips_gemini(self):
+        """Test repeated questions are answered from the response cache."""
+        mock_model = Mock()
+        mock_response = Mock()
+        mock_response.text = "AI generated response"
+        mock_model.generate_content.return_value = mock_response
+        self.service.gemini_model = mock_model
+
+        first = self.service._get_ai_response("Where is my order?")
+        second = self.service._get_ai_response("  where is my ORDER?  ")
+
+        self.assertEqual(first, "AI generated response")
+        self.assertEqual(second, "AI generated response")
+        self.assertEqual(mock_model.generate_content.call_count, 1)
+
+    @patch('chatbot_server.time.time')
+    def test_semantic_cache_ttl_expiry(self, mock_time):
+        """Test cached responses expire after the TTL."""
+        mock_time.return_value = 1000.0
+        cache = chatbot_server.SemanticCache(max_entries=10, ttl_seconds=60)
+        cache.put("Hello", "Hi there")
+        self.assertEqual(cache.get("hello"), "Hi there")
+
+        mock_time.return_value = 1061.0
+        self.assertIsNone(cache.get("hello"))
+        self.assertEqual(len(cache), 0)
+
+    def test_semantic_cache_lru_eviction(self):
+        """Test the least recently used entry is evicted when the cache is full."""
+        cache = chatbot_server.SemanticCache(max_entries=2, ttl_seconds=60)
+        cache.put("first", "1")
+        cache.put("second", "2")
+        cache.get("first")
+        cache.put("third", "3")
+
+        self.assertEqual(cache.get("first"), "1")
+        self.assertIsNone(cache.get("second"))
+        self.assertEqual(cache.get("third"), "3")
+
+
+@pytest.mark.parametrize("query,needles", [
+    pytest.param("What's my order status?", ("order", "track"), id="order"),
+    pytest.param("I want to return this item", ("return",), id="return"),
+    pytest.param("Do you have this product?", ("product",), id="product"),
+    pytest.param("How long does shipping take?", ("shipping", "delivery"), id="shipping"),
+    # The higher priority intent wins when several keywords match
+    pytest.param("Shipping was slow, can I return my order?", ("track your order",), id="intent-priority"),
+    pytest.param("Hello", ("online boutique", "help"), id="general"),
+])
+def test_fallback_response(chatbot_service, query, needles):
+    """Test rule-based fallback responses for each intent."""
+    response = chatbot_service._get_fallback_response(query).lower()
+    for needle in needles:
+        assert needle in response
+
+
+def test_send_chat_message_logs_one_chat_turn(chatbot_service, fake_grpc_context, json_logs):
+    """Each chat turn is written as a single JSON record carrying its fields."""
+    records = json_logs(chatbot_server.logger)
+    request = demo_pb2.ChatRequest(message="Where is my order?", user_id="log-user")
+    response = chatbot_service.SendChatMessage(request, fake_grpc_context)
+
+    turns = [r for r in records() if r['message'] == "[Chat] chat_turn"]
+    assert len(turns) == 1
+    assert turns[0]['user_id'] == "log-user"
+    assert turns[0]['user_message'] == "Where is my order?"
+    assert turns[0]['bot_response'] == response.message
+
+
+@pytest.fixture
+def semantic_cache(monkeypatch):
+    """Build SemanticCaches whose embedding tier uses a bag-of-keywords stub encoder."""
+    np = pytest.importorskip("numpy")
+    vocab = ("order", "return", "shipping", "product")
+    
+    class StubEncoder(object):
+        def __init__(self, model_name):
+            pass
+        
+        def get_sentence_embedding_dimension(self):
+            return len(vocab)
+        
+        def encode(self, text, normalize_embeddings=False):
+            vector = np.array([text.count(word) for word in vocab], dtype=np.float64)
+            norm = np.linalg.norm(vector)
+            return vector / norm if normalize_embeddings and norm else vector
+    
+    monkeypatch.setattr(chatbot_server, 'np', np)
+    monkeypatch.setattr(chatbot_server, 'SentenceTransformer', StubEncoder)
+    
+    def build(max_entries=4, ttl_seconds=60, similarity_threshold=0.92):
+        return chatbot_server.SemanticCache(max_entries=max_entries, ttl_seconds=ttl_seconds,
+                                            similarity_threshold=similarity_threshold)
+    return build
+
+
+def _assert_all_slots_free(cache):
+    assert not cache._occupied.any()
+    assert cache._slot_keys == [None] * cache.max_entries
+    assert sorted(cache._free_slots) == list(range(cache.max_entries))
+
+
+def test_semantic_cache_near_duplicate_hit(semantic_cache):
+    """Test a differently worded message above the similarity threshold hits the cache."""
+    cache = semantic_cache()
+    cache.put("Where is my order?", "Track it in your account")
+    
+    assert cache._encoder is not None
+    assert cache.get("Can you tell me where my order is?") == "Track it in your account"
+
+
+def test_semantic_cache_miss_below_threshold(semantic_cache):
+    """Test messages below the similarity threshold miss the cache."""
+    cache = semantic_cache()
+    cache.put("Where is my order?", "Track it in your account")
+    
+    assert cache.get("Can I return my order?") is None  # Cosine similarity ~0.71
+    assert cache.get("How long does shipping take?") is None
+
+
+def test_semantic_cache_reuses_slot_after_lru_eviction(semantic_cache):
+    """Test the least recently used entry's embedding slot is reused and no longer matches."""
+    cache = semantic_cache(max_entries=2)
+    cache.put("order status", "order")
+    evicted_slot = cache._entries[cache._key("order status")][2]
+    cache.put("return policy", "return")
+    cache.put("shipping times", "shipping")
+    
+    assert cache._entries[cache._key("shipping times")][2] == evicted_slot
+    assert int(cache._occupied.sum()) == 2
+    assert cache._free_slots == []
+    assert cache.get("my order status") is None
+    assert cache.get("what are the shipping times") == "shipping"
+
+
+def test_semantic_cache_miss_embeds_message_once(semantic_cache):
+    """Test a miss followed by put() encodes the message only once."""
+    cache = semantic_cache()
+    cache._encoder.encode = Mock(wraps=cache._encoder.encode)
+    
+    response, embedding = cache.lookup("Where is my order?")
+    assert response is None
+    cache.put("Where is my order?", "Track it in your account", embedding)
+    
+    assert cache._encoder.encode.call_count == 1
+    assert cache.get("where is my order please") == "Track it in your account"
+
+
+@patch('chatbot_server.time.time')
+def test_semantic_cache_releases_slot_after_ttl(mock_time, semantic_cache):
+    """Test an expired entry found by the semantic tier is evicted and its slot reused."""
+    mock_time.return_value = 1000.0
+    cache = semantic_cache(max_entries=1, ttl_seconds=60)
+    cache.put("order status", "order")
+    
+    mock_time.return_value = 1061.0
+    assert cache.get("my order status") is None
+    assert len(cache) == 0
+    _assert_all_slots_free(cache)
+    
+    cache.put("return policy", "return")
+    assert cache.get("what is the return policy") == "return"
+
+
+def test_semantic_cache_clear_releases_all_slots(semantic_cache):
+    """Test clear() empties the cache and frees every embedding slot."""
+    cache = semantic_cache(max_entries=3)
+    for message in ("order status", "return policy", "shipping times"):
+        cache.put(message, message)
+    
+    cache.clear()
+    
+    assert len(cache) == 0
+    _assert_all_slots_free(cache)
+    assert cache.get("my order status") is None
@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+#
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Latency benchmarks for the fraud detection servicer.
+
+Benchmarks are disabled automatically under xdist; CI runs them serially with
+--benchmark-only.
+"""
+
+from unittest.mock import Mock
+
+import pytest
+
+import fraud_detection_server
+import demo_pb2
+
+
+@pytest.fixture(scope="module")
+def service():
+    """Fraud service whose Gemini model answers instantly."""
+    service = fraud_detection_server.FraudDetectionService(gemini_api_key='')
+    service.gemini_model = Mock()
+    service.gemini_model.generate_content.return_value = Mock(text="SCORE:0.1|REASON:Low risk")
+    return service
+
+
+@pytest.fixture
+def valid_request():
+    request = demo_pb2.FraudCheckRequest()
+    request.amount.units = 100
+    request.amount.currency_code = "USD"
+    request.credit_card.credit_card_number = "4532015112830366"
+    request.credit_card.credit_card_expiration_month = 12
+    request.credit_card.credit_card_expiration_year = 2030
+    request.user_id = "bench-user"
+    return request
+
+
+def test_check_fraud_bench(benchmark, service, valid_request, fake_grpc_context):
+    """Luhn, amount, velocity and cached AI assessment for a legitimate transaction."""
+    history = service._history(valid_request.user_id)
+    
+    def check_fraud():
+        # Start every round from an empty history so the velocity limit is
+        # never reached and the legitimate-transaction path is measured
+        history.clear()
+        return service.CheckFraud(valid_request, fake_grpc_context)
+    
+    response = benchmark(check_fraud)
+    
+    assert not response.is_fraud
+    assert response.reason == "Low risk"
@@ -1,36 +1,65 @@
 #!/usr/bin/env python3
 
+import asyncio
+import itertools
+import time
 import unittest
+from concurrent import futures
 from unittest.mock import Mock, patch, MagicMock
-import sys
-import os
+import threading
 
-# Add the src directory to the path
-sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src', 'frauddetectionservice'))
+import pytest
 
 import fraud_detection_server
 import demo_pb2
 
+# A $10 transaction one second before the frozen clock's default time
+_RECENT_TRANSACTION = (999.0, 10.0)
+
 class TestFraudDetectionService(unittest.TestCase):
     
+    @pytest.fixture(autouse=True)
+    def _use_fake_context(self, fake_grpc_context, frozen_time):
+        self.context = fake_grpc_context
+        self.frozen_time = frozen_time
+    
+    @classmethod
+    def setUpClass(cls):
+        """Build one service for the whole class; tests only reset its state."""
+        cls.shared_service = fraud_detection_server.FraudDetectionService()
+        cls._initial_state = dict(cls.shared_service.__dict__)
+        
+        # Legitimate transaction; tests copy it and change only what they exercise
+        cls._BASE_FRAUD_REQ = demo_pb2.FraudCheckRequest()
+        cls._BASE_FRAUD_REQ.amount.units = 100
+        cls._BASE_FRAUD_REQ.amount.currency_code = "USD"
+        cls._BASE_FRAUD_REQ.credit_card.credit_card_number = "4532015112830366"  # Valid test number
+        cls._BASE_FRAUD_REQ.credit_card.credit_card_expiration_month = 12
+        cls._BASE_FRAUD_REQ.credit_card.credit_card_expiration_year = 2030
+        cls._BASE_FRAUD_REQ.credit_card.credit_card_cvv = 123
+        cls._BASE_FRAUD_REQ.user_id = "test-user"
+    
     def setUp(self):
         """Set up test fixtures before each test method."""
-        self.service = fraud_detection_server.FraudDetectionService()
+        self.service = self.shared_service
+        for shard in self.service._shards:
+            shard["hist"].clear()
+        self.service.assessment_cache.clear()
+    
+    def tearDown(self):
+        """Drop per-test overrides such as mocked methods or models."""
+        self.service.__dict__.clear()
+        self.service.__dict__.update(self._initial_state)
         
     def test_initialization_without_gemini_key(self):
         """Test service initialization without Gemini API key."""
-        with patch.dict(os.environ, {}, clear=True):
-            service = fraud_detection_server.FraudDetectionService()
-            self.assertIsNone(service.gemini_model)
+        service = fraud_detection_server.FraudDetectionService(gemini_api_key='')
+        self.assertIsNone(service.gemini_model)
     
     def test_valid_credit_card_luhn(self):
         """Test credit card validation with valid Luhn algorithm."""
-        # Create valid credit card (test number)
         credit_card = demo_pb2.CreditCardInfo()
-        credit_card.credit_card_number = "4532015112830366"  # Valid test number
-        credit_card.credit_card_expiration_month = 12
-        credit_card.credit_card_expiration_year = 2025
-        credit_card.credit_card_cvv = 123
+        credit_card.CopyFrom(self._BASE_FRAUD_REQ.credit_card)
         
         is_valid, message = self.service._validate_credit_card(credit_card)
         self.assertTrue(is_valid)
@@ -39,18 +68,26 @@ class TestFraudDetectionService(unittest.TestCase):
     def test_invalid_credit_card_luhn(self):
         """Test credit card validation with invalid Luhn algorithm."""
         credit_card = demo_pb2.CreditCardInfo()
+        credit_card.CopyFrom(self._BASE_FRAUD_REQ.credit_card)
         credit_card.credit_card_number = "1234567890123456"  # Invalid Luhn
-        credit_card.credit_card_expiration_month = 12
-        credit_card.credit_card_expiration_year = 2025
         
         is_valid, message = self.service._validate_credit_card(credit_card)
         self.assertFalse(is_valid)
         self.assertIn("Invalid credit card number", message)
     
+    def test_credit_card_number_with_separators(self):
+        """Test credit card validation ignores spaces and dashes."""
+        credit_card = demo_pb2.CreditCardInfo()
+        credit_card.CopyFrom(self._BASE_FRAUD_REQ.credit_card)
+        credit_card.credit_card_number = "4532 0151-1283 0366"
+        
+        is_valid, message = self.service._validate_credit_card(credit_card)
+        self.assertTrue(is_valid)
+    
     def test_expired_credit_card(self):
         """Test credit card validation with expired card."""
         credit_card = demo_pb2.CreditCardInfo()
-        credit_card.credit_card_number = "4532015112830366"
+        credit_card.CopyFrom(self._BASE_FRAUD_REQ.credit_card)
         credit_card.credit_card_expiration_month = 1
         credit_card.credit_card_expiration_year = 2020  # Expired
         
@@ -58,115 +95,103 @@ class TestFraudDetectionService(unittest.TestCase):
         self.assertFalse(is_valid)
         self.assertIn("expired", message.lower())
     
-    def test_amount_fraud_negative_amount(self):
-        """Test amount fraud detection with negative amount."""
-        is_fraud, message = self.service._check_amount_fraud(-100.0)
-        self.assertTrue(is_fraud)
-        self.assertIn("Invalid amount", message)
-    
-    def test_amount_fraud_high_amount(self):
-        """Test amount fraud detection with high amount."""
-        is_fraud, message = self.service._check_amount_fraud(15000.0)
-        self.assertTrue(is_fraud)
-        self.assertIn("Amount too high", message)
-    
-    def test_amount_fraud_suspicious_pattern(self):
-        """Test amount fraud detection with suspicious amount pattern."""
-        is_fraud, message = self.service._check_amount_fraud(9999.99)
-        self.assertTrue(is_fraud)
-        self.assertIn("Suspicious amount pattern", message)
-    
-    def test_amount_fraud_normal_amount(self):
-        """Test amount fraud detection with normal amount."""
-        is_fraud, message = self.service._check_amount_fraud(99.99)
-        self.assertFalse(is_fraud)
-        self.assertIn("Amount check passed", message)
-    
-    @patch('fraud_detection_server.time.time')
-    def test_velocity_fraud_too_many_transactions(self, mock_time):
-        """Test velocity fraud detection with too many transactions."""
-        mock_time.return_value = 1000.0
-        
-        # Add multiple transactions within the time window
-        user_id = "test-user"
-        for i in range(6):  # More than threshold of 5
-            self.service.transaction_history[user_id].append((999.0, 10.0))
+    def test_credit_card_expiration_year_out_of_range(self):
+        """Test expiry years outside the calendar range are rejected as invalid."""
+        credit_card = demo_pb2.CreditCardInfo()
+        credit_card.CopyFrom(self._BASE_FRAUD_REQ.credit_card)
         
-        is_fraud, message = self.service._check_velocity_fraud(user_id, 10.0)
-        self.assertTrue(is_fraud)
-        self.assertIn("Too many transactions", message)
+        for year in (0, 10000, 99999):
+            credit_card.credit_card_expiration_year = year
+            self.assertEqual(self.service._validate_credit_card(credit_card),
+                             (False, "Invalid expiration date"), year)
     
     @patch('fraud_detection_server.time.time')
-    def test_velocity_fraud_daily_limit_exceeded(self, mock_time):
-        """Test velocity fraud detection with daily limit exceeded."""
-        mock_time.return_value = 1000.0
+    def test_credit_card_valid_through_expiry_month(self, mock_time):
+        """Test a card stays valid until the end of its expiration month."""
+        mock_time.return_value = 1815000000.0  # July 2027
         
-        # Add transaction that exceeds daily limit
-        user_id = "test-user"
-        self.service.transaction_history[user_id].append((500.0, 40000.0))  # Large amount
+        credit_card = demo_pb2.CreditCardInfo()
+        credit_card.CopyFrom(self._BASE_FRAUD_REQ.credit_card)
+        credit_card.credit_card_expiration_year = 2027
         
-        is_fraud, message = self.service._check_velocity_fraud(user_id, 15000.0)  # Would exceed 50k limit
-        self.assertTrue(is_fraud)
-        self.assertIn("Daily spending limit exceeded", message)
-    
-    @patch('fraud_detection_server.time.time')
-    def test_velocity_fraud_normal_pattern(self, mock_time):
-        """Test velocity fraud detection with normal transaction pattern."""
-        mock_time.return_value = 1000.0
+        credit_card.credit_card_expiration_month = 7
+        is_valid, message = self.service._validate_credit_card(credit_card)
+        self.assertTrue(is_valid)
         
-        user_id = "test-user"
-        is_fraud, message = self.service._check_velocity_fraud(user_id, 100.0)
-        self.assertFalse(is_fraud)
-        self.assertIn("Velocity check passed", message)
+        credit_card.credit_card_expiration_month = 6
+        is_valid, message = self.service._validate_credit_card(credit_card)
+        self.assertFalse(is_valid)
+        self.assertIn("expired", message.lower())
     
     def test_check_fraud_success_no_fraud(self):
         """Test fraud check with legitimate transaction."""
-        # Create valid request
         request = demo_pb2.FraudCheckRequest()
-        
-        # Valid amount
-        request.amount.units = 100
-        request.amount.nanos = 0
-        request.amount.currency_code = "USD"
-        
-        # Valid credit card
-        request.credit_card.credit_card_number = "4532015112830366"
-        request.credit_card.credit_card_expiration_month = 12
-        request.credit_card.credit_card_expiration_year = 2025
-        request.credit_card.credit_card_cvv = 123
-        
-        request.user_id = "test-user"
-        
-        # Mock context
-        context = Mock()
+        request.CopyFrom(self._BASE_FRAUD_REQ)
         
         # Mock AI assessment to return low risk
+        self.service.gemini_model = Mock()
         self.service._get_ai_fraud_assessment = Mock(return_value=(0.1, "Low risk"))
         
-        response = self.service.CheckFraud(request, context)
+        response = self.service.CheckFraud(request, self.context)
         
         self.assertFalse(response.is_fraud)
         self.assertLess(response.risk_score, 0.7)
     
-    def test_check_fraud_invalid_card(self):
-        """Test fraud check with invalid credit card."""
+    def test_check_fraud_ai_sees_last_minute_only(self):
+        """Test the AI assessment counts only last-minute transactions, not the whole day."""
         request = demo_pb2.FraudCheckRequest()
+        request.CopyFrom(self._BASE_FRAUD_REQ)
+        self.service._history(request.user_id).extend([(500.0, 10.0), _RECENT_TRANSACTION])
         
-        # Valid amount
-        request.amount.units = 100
-        request.amount.nanos = 0
-        request.amount.currency_code = "USD"
+        self.service.gemini_model = Mock()
+        self.service._get_ai_fraud_assessment = Mock(return_value=(0.1, "Low risk"))
+        self.service.CheckFraud(request, self.context)
         
-        # Invalid credit card
-        request.credit_card.credit_card_number = "1234567890123456"  # Invalid Luhn
-        request.credit_card.credit_card_expiration_month = 12
-        request.credit_card.credit_card_expiration_year = 2025
+        transaction_data = self.service._get_ai_fraud_assessment.call_args.args[0]
+        self.assertEqual(transaction_data['recent_transactions'], 1)
+        self.assertEqual(transaction_data['user_pattern'], "1 recent transactions")
+    
+    def test_check_fraud_without_gemini_skips_ai_pool(self):
+        """Test checks without a Gemini model or for a cached profile stay on the RPC thread."""
+        request = demo_pb2.FraudCheckRequest()
+        request.CopyFrom(self._BASE_FRAUD_REQ)
+        self.service._aux_pool = Mock()
         
-        request.user_id = "test-user"
+        response = self.service.CheckFraud(request, self.context)
+        self.assertEqual(response.reason, "AI assessment not available")
         
-        context = Mock()
+        self.service.gemini_model = Mock()
+        # The first check was recorded, so the profile now has one recent transaction
+        self.service.assessment_cache.put(
+            self.service._assessment_cache_key({'amount': 100.0, 'currency': 'USD', 'card_type': '4532',
+                                                'recent_transactions': 1}),
+            (0.1, "Cached verdict"))
+        response = self.service.CheckFraud(request, self.context)
+        self.assertEqual(response.reason, "Cached verdict")
         
-        response = self.service.CheckFraud(request, context)
+        self.assertEqual(self.service._aux_pool.submit.call_count, 0)
+        self.assertEqual(self.service.gemini_model.generate_content.call_count, 0)
+    
+    def test_check_fraud_error_discards_recorded_transaction(self):
+        """Test a transaction recorded by the velocity check is dropped when the RPC fails."""
+        request = demo_pb2.FraudCheckRequest()
+        request.CopyFrom(self._BASE_FRAUD_REQ)
+        self.service.gemini_model = Mock()
+        self.service._get_ai_fraud_assessment = Mock(side_effect=RuntimeError("boom"))
+        
+        response = self.service.CheckFraud(request, self.context)
+        
+        self.assertTrue(response.is_fraud)
+        self.assertEqual(len(self.service._history(request.user_id)), 0)
+        self.assertEqual(self.service._history(request.user_id).total, 0.0)
+    
+    def test_check_fraud_invalid_card(self):
+        """Test fraud check with invalid credit card."""
+        request = demo_pb2.FraudCheckRequest()
+        request.CopyFrom(self._BASE_FRAUD_REQ)
+        request.credit_card.credit_card_number = "1234567890123456"  # Invalid Luhn
+        
+        response = self.service.CheckFraud(request, self.context)
         
         self.assertTrue(response.is_fraud)
         self.assertGreater(response.risk_score, 0.7)
@@ -175,62 +200,333 @@ class TestFraudDetectionService(unittest.TestCase):
     def test_check_fraud_high_amount(self):
         """Test fraud check with suspiciously high amount."""
         request = demo_pb2.FraudCheckRequest()
+        request.CopyFrom(self._BASE_FRAUD_REQ)
+        request.amount.units = 15000  # High amount
         
-        # High amount
-        request.amount.units = 15000
-        request.amount.nanos = 0
-        request.amount.currency_code = "USD"
+        response = self.service.CheckFraud(request, self.context)
         
-        # Valid credit card
-        request.credit_card.credit_card_number = "4532015112830366"
-        request.credit_card.credit_card_expiration_month = 12
-        request.credit_card.credit_card_expiration_year = 2025
+        self.assertTrue(response.is_fraud)
+        self.assertIn("Amount too high", response.reason)
+    
+    @patch('fraud_detection_server.AI_ASSESSMENT_TIMEOUT_SECONDS', 0.01)
+    def test_check_fraud_ai_timeout(self):
+        """Test fraud check falls back when the AI assessment is too slow."""
+        request = demo_pb2.FraudCheckRequest()
+        request.CopyFrom(self._BASE_FRAUD_REQ)
         
-        request.user_id = "test-user"
+        release = threading.Event()
+        def slow_assessment(transaction_data):
+            release.wait(5)
+            return 1.0, "High risk"
+        self.service.gemini_model = Mock()
+        self.service._get_ai_fraud_assessment = slow_assessment
         
-        context = Mock()
+        try:
+            response = self.service.CheckFraud(request, self.context)
+        finally:
+            release.set()
         
-        response = self.service.CheckFraud(request, context)
+        self.assertFalse(response.is_fraud)
+        self.assertEqual(response.reason, "AI timeout")
+    
+    @patch('fraud_detection_server.AI_ASSESSMENT_TIMEOUT_SECONDS', 0.01)
+    def test_check_fraud_ai_timeout_cancels_queued_assessment(self):
+        """Test assessments still queued when their RPC times out never reach Gemini."""
+        request = demo_pb2.FraudCheckRequest()
+        request.CopyFrom(self._BASE_FRAUD_REQ)
         
-        self.assertTrue(response.is_fraud)
-        self.assertIn("Amount too high", response.reason)
+        pool = futures.ThreadPoolExecutor(max_workers=1)
+        self.service._aux_pool = pool
+        self.service._ai_timeouts = itertools.count(1)
+        release = threading.Event()
+        calls = []
+        def slow_assessment(transaction_data):
+            calls.append(transaction_data)
+            release.wait(5)
+            return 1.0, "High risk"
+        self.service.gemini_model = Mock()
+        self.service._get_ai_fraud_assessment = slow_assessment
+        
+        try:
+            first = self.service.CheckFraud(request, self.context)
+            second = self.service.CheckFraud(request, self.context)
+        finally:
+            release.set()
+            pool.shutdown(wait=True)
+        
+        self.assertEqual([first.reason, second.reason], ["AI timeout", "AI timeout"])
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(next(self.service._ai_timeouts), 3)
     
-    @patch('fraud_detection_server.genai')
-    def test_ai_fraud_assessment_with_gemini(self, mock_genai):
+    def test_ai_fraud_assessment_with_gemini(self):
         """Test AI fraud assessment with Gemini."""
         mock_model = Mock()
         mock_response = Mock()
         mock_response.text = "SCORE:0.3|REASON:Moderate risk transaction"
         mock_model.generate_content.return_value = mock_response
+        self.service.gemini_model = mock_model
+        
+        transaction_data = {
+            'amount': 100.0,
+            'currency': 'USD',
+            'card_type': '4532',
+            'timestamp': '2024-01-01T00:00:00',
+            'user_pattern': '0 recent transactions'
+        }
         
-        with patch.dict(os.environ, {'GEMINI_API_KEY': 'test-key'}):
-            service = fraud_detection_server.FraudDetectionService()
-            service.gemini_model = mock_model
-            
-            transaction_data = {
-                'amount': 100.0,
-                'currency': 'USD',
-                'card_type': '4532',
-                'timestamp': '2024-01-01T00:00:00',
-                'user_pattern': '0 recent transactions'
-            }
-            
-            score, reason = service._get_ai_fraud_assessment(transaction_data)
-            
-            self.assertEqual(score, 0.3)
-            self.assertEqual(reason, "Moderate risk transaction")
-            mock_model.generate_content.assert_called_once()
+        score, reason = self.service._get_ai_fraud_assessment(transaction_data)
+        
+        self.assertEqual(score, 0.3)
+        self.assertEqual(reason, "Moderate risk transaction")
+        self.assertEqual(mock_model.generate_content.call_count, 1)
+        prompt = mock_model.generate_content.call_args[0][0]
+        self.assertIn("Amount: $100.00", prompt)
+        self.assertNotIn("Format:", prompt)
+    
+    def test_ai_fraud_assessment_unparseable_response(self):
+        """Test AI fraud assessment falls back when Gemini ignores the response format."""
+        mock_model = Mock()
+        mock_model.generate_content.return_value = Mock(text="garbage")
+        self.service.gemini_model = mock_model
+        
+        transaction_data = {'amount': 100.0, 'currency': 'USD', 'card_type': '4532', 'recent_transactions': 0}
+        score, reason = self.service._get_ai_fraud_assessment(transaction_data)
+        
+        self.assertEqual(score, 0.2)
+        self.assertEqual(reason, "AI assessment completed")
+        
+        # The fallback is not cached; the next transaction in the bucket asks Gemini again
+        mock_model.generate_content.return_value = Mock(text="SCORE:0.3|REASON:Moderate risk transaction")
+        self.assertEqual(self.service._get_ai_fraud_assessment(transaction_data),
+                         (0.3, "Moderate risk transaction"))
+        self.assertEqual(mock_model.generate_content.call_count, 2)
+    
+    def test_ai_fraud_assessment_cached_by_profile(self):
+        """Test transactions with the same coarse profile reuse the AI assessment."""
+        mock_model = Mock()
+        mock_response = Mock()
+        mock_response.text = "SCORE:0.3|REASON:Moderate risk transaction"
+        mock_model.generate_content.return_value = mock_response
+        self.service.gemini_model = mock_model
+        
+        first = {'amount': 102.0, 'currency': 'USD', 'card_type': '4532', 'recent_transactions': 1}
+        second = {'amount': 98.5, 'currency': 'USD', 'card_type': '4532', 'recent_transactions': 1}
+        other = {'amount': 98.5, 'currency': 'EUR', 'card_type': '4532', 'recent_transactions': 1}
+        
+        self.assertEqual(self.service._get_ai_fraud_assessment(first), (0.3, "Moderate risk transaction"))
+        self.assertEqual(self.service._get_ai_fraud_assessment(second), (0.3, "Moderate risk transaction"))
+        self.assertEqual(mock_model.generate_content.call_count, 1)
+        
+        self.service._get_ai_fraud_assessment(other)
+        self.assertEqual(mock_model.generate_content.call_count, 2)
     
     def test_ai_fraud_assessment_without_gemini(self):
         """Test AI fraud assessment fallback without Gemini."""
-        service = fraud_detection_server.FraudDetectionService()
-        service.gemini_model = None
+        self.service.gemini_model = None
         
         transaction_data = {}
-        score, reason = service._get_ai_fraud_assessment(transaction_data)
+        score, reason = self.service._get_ai_fraud_assessment(transaction_data)
         
         self.assertEqual(score, 0.0)
         self.assertIn("not available", reason)
 
-if __name__ == '__main__':
-    unittest.main()
+
+
+
+def test_transaction_window_total_tracks_contents():
+    """Test the running total follows appends, extends, expiry and clear."""
+    window = fraud_detection_server.TransactionWindow([(1.0, 10.0), (2.0, 20.0)])
+    window.append((3.0, 30.0))
+    window.extend([(4.0, 40.0)])
+    assert (len(window), window.total) == (4, 100.0)
+    
+    window.expire(2.0)
+    assert (len(window), window.total) == (2, 70.0)
+    assert window.count_since(3.0) == 1
+    
+    window.clear()
+    assert (len(window), window.total) == (0, 0.0)
+    assert not hasattr(window, 'pop') and not hasattr(window, 'appendleft')
+
+
+class TestVelocityFraud:
+    """Velocity checks against one shared service; only the histories are reset."""
+    
+    @pytest.fixture(autouse=True)
+    def service(self, fraud_service, frozen_time):
+        for shard in fraud_service._shards:
+            shard["hist"].clear()
+        return fraud_service
+    
+    def test_too_many_transactions(self, service):
+        """Test velocity fraud detection with too many transactions."""
+        # Add multiple transactions within the time window
+        user_id = "test-user"
+        service._history(user_id).extend([_RECENT_TRANSACTION] * 6)  # More than threshold of 5
+        
+        is_fraud, message = service._check_velocity_fraud(user_id, 10.0)
+        assert is_fraud
+        assert "Too many transactions" in message
+    
+    @pytest.mark.parametrize("count", [0, 1, 4, 5, 6, 20])
+    def test_transaction_count_sweep(self, service, count):
+        """Test the velocity threshold is reached at exactly velocity_threshold recent transactions."""
+        user_id = "test-user"
+        service._history(user_id).extend([_RECENT_TRANSACTION] * count)
+        
+        is_fraud, message = service._check_velocity_fraud(user_id, 10.0)
+        assert is_fraud is (count >= service.velocity_threshold)
+    
+    def test_daily_limit_exceeded(self, service):
+        """Test velocity fraud detection with daily limit exceeded."""
+        # Add transaction that exceeds daily limit
+        user_id = "test-user"
+        service._history(user_id).append((500.0, 40000.0))  # Large amount
+        
+        is_fraud, message = service._check_velocity_fraud(user_id, 15000.0)  # Would exceed 50k limit
+        assert is_fraud
+        assert "Daily spending limit exceeded" in message
+    
+    def test_expires_old_transactions(self, service, frozen_time):
+        """Test transactions older than a day no longer count toward the daily limit."""
+        frozen_time[0] = 100000.0
+        
+        user_id = "test-user"
+        service._history(user_id).append((1000.0, 40000.0))  # Over a day old
+        service._history(user_id).append((99000.0, 5000.0))
+        
+        is_fraud, message = service._check_velocity_fraud(user_id, 15000.0)
+        assert not is_fraud
+        assert len(service._history(user_id)) == 1
+        assert service._history(user_id).total == 5000.0
+    
+    def test_normal_pattern(self, service):
+        """Test velocity fraud detection with normal transaction pattern."""
+        user_id = "test-user"
+        is_fraud, message = service._check_velocity_fraud(user_id, 100.0)
+        assert not is_fraud
+        assert "Velocity check passed" in message
+
+
+@pytest.mark.parametrize("amount,expected_fraud,needle", [
+    pytest.param(-100.0, True, "Invalid amount", id="negative"),
+    pytest.param(15000.0, True, "Amount too high", id="high"),
+    pytest.param(9999.99, True, "Suspicious amount pattern", id="suspicious"),
+    # 5000 units and 1 nano; suspicious amounts are matched in cents despite float rounding
+    pytest.param(float(5000 + 1 / 1e9), True, "Suspicious amount pattern", id="suspicious-units-and-nanos"),
+    pytest.param(99.99, False, "Amount check passed", id="normal"),
+])
+def test_amount_fraud(fraud_service, amount, expected_fraud, needle):
+    """Test amount fraud detection."""
+    is_fraud, message = fraud_service._check_amount_fraud(amount)
+    assert is_fraud is expected_fraud
+    assert needle in message
+
+
+
+
+def test_concurrent_checks_for_one_user_respect_velocity_limit(fake_grpc_context):
+    """Concurrent checks for the same user can't all slip under the velocity threshold."""
+    def slow_generate(prompt):
+        time.sleep(0.2)
+        return Mock(text="SCORE:0.1|REASON:Low risk")
+    
+    service = fraud_detection_server.FraudDetectionService(gemini_api_key='')
+    service.gemini_model = Mock()
+    service.gemini_model.generate_content.side_effect = slow_generate
+    
+    request = demo_pb2.FraudCheckRequest()
+    request.amount.units = 100
+    request.amount.currency_code = "USD"
+    request.credit_card.credit_card_number = "4532015112830366"
+    request.credit_card.credit_card_expiration_month = 12
+    request.credit_card.credit_card_expiration_year = 2030
+    request.user_id = "same-user"
+    
+    with futures.ThreadPoolExecutor(max_workers=20) as pool:
+        responses = list(pool.map(lambda _: service.CheckFraud(request, fake_grpc_context), range(20)))
+    
+    approved = [r for r in responses if not r.is_fraud]
+    assert len(approved) == service.velocity_threshold
+    assert len(service._history("same-user")) == service.velocity_threshold
+
+
+def test_check_fraud_logs_one_fraud_check(fake_grpc_context, json_logs):
+    """Each fraud check is written as a single JSON record carrying its verdict."""
+    records = json_logs(fraud_detection_server.logger)
+    service = fraud_detection_server.FraudDetectionService(gemini_api_key='')
+    
+    request = demo_pb2.FraudCheckRequest()
+    request.amount.units = 42
+    request.amount.currency_code = "EUR"
+    request.credit_card.credit_card_number = "4532015112830366"
+    request.credit_card.credit_card_expiration_month = 12
+    request.credit_card.credit_card_expiration_year = 2030
+    request.user_id = "log-user"
+    response = service.CheckFraud(request, fake_grpc_context)
+    
+    checks = [r for r in records() if r['message'] == "[Fraud Check] fraud_check"]
+    assert len(checks) == 1
+    assert checks[0]['user_id'] == "log-user"
+    assert checks[0]['amount'] == 42.0
+    assert checks[0]['currency'] == "EUR"
+    assert checks[0]['is_fraud'] is response.is_fraud
+    assert checks[0]['risk_score'] == round(response.risk_score, 2)
+    assert checks[0]['reason'] == response.reason
+
+
+def test_luhn_batch(fraud_service):
+    """Test card validation agrees with a vectorized Luhn check on many cards."""
+    np = pytest.importorskip("numpy")
+    rng = np.random.default_rng(20240101)
+    digits = rng.integers(0, 10, size=(500, 16), dtype=np.int8)
+    digits[:, 0] = rng.integers(1, 10, size=500)  # No leading zeros
+    cards = ["".join(map(str, row)) for row in digits]
+    
+    # Double every second digit from the right, summing the digits of the product
+    mask = np.tile(np.array([2, 1], dtype=np.int8), 8)
+    doubled = digits * mask
+    doubled -= 9 * (doubled > 9)
+    valid = doubled.sum(axis=1) % 10 == 0
+    assert valid.any() and not valid.all()
+    
+    credit_card = demo_pb2.CreditCardInfo()
+    credit_card.credit_card_expiration_month = 12
+    credit_card.credit_card_expiration_year = 2030
+    for card, expected in zip(cards, valid):
+        credit_card.credit_card_number = card
+        is_valid, message = fraud_service._validate_credit_card(credit_card)
+        assert is_valid is bool(expected), card
+
+
+async def test_concurrent_fraud_checks_overlap_ai_latency(fake_grpc_context):
+    """Concurrent CheckFraud RPCs wait on Gemini in parallel, not one after another."""
+    latency = 0.2
+    def slow_generate(prompt):
+        time.sleep(latency)
+        return Mock(text="SCORE:0.1|REASON:Low risk")
+    
+    service = fraud_detection_server.FraudDetectionService()
+    service.gemini_model = Mock()
+    service.gemini_model.generate_content.side_effect = slow_generate
+    
+    requests = []
+    for i in range(8):
+        request = demo_pb2.FraudCheckRequest()
+        request.amount.units = 100 * (i + 1)  # Distinct amounts so nothing is cached
+        request.amount.nanos = 10000000
+        request.amount.currency_code = "USD"
+        request.credit_card.credit_card_number = "4532015112830366"
+        request.credit_card.credit_card_expiration_month = 12
+        request.credit_card.credit_card_expiration_year = 2030
+        request.user_id = f"user-{i}"
+        requests.append(request)
+    
+    start = time.monotonic()
+    responses = await asyncio.gather(*(
+        asyncio.to_thread(service.CheckFraud, request, fake_grpc_context) for request in requests))
+    elapsed = time.monotonic() - start
+    
+    assert [r.reason for r in responses] == ["Low risk"] * len(requests)
+    assert service.gemini_model.generate_content.call_count == len(requests)
+    assert elapsed < latency * len(requests) / 2
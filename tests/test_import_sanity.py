@@ -0,0 +1,38 @@
+#!/usr/bin/env python3
+#
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Checks that the test layout imports each service module exactly once."""
+
+import pathlib
+import sys
+
+import chatbot_server
+import demo_pb2
+import fraud_detection_server
+import logger
+
+
+def _aliases(module):
+    """Names in sys.modules that were loaded from the same file as module."""
+    path = pathlib.Path(module.__file__).resolve()
+    return sorted(name for name, loaded in list(sys.modules.items())
+                  if getattr(loaded, '__file__', None) and pathlib.Path(loaded.__file__).resolve() == path)
+
+
+def test_modules_loaded_once():
+    for module in (chatbot_server, fraud_detection_server, demo_pb2, logger):
+        assert _aliases(module) == [module.__name__]
+